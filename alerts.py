@@ -0,0 +1,142 @@
+import bisect
+import itertools
+
+from datatypes import Alert
+
+
+# Fenwick tree counting live slots, maps display rows to slots in O(log n)
+class SlotCounter:
+    def __init__(self) -> None:
+        self._tree = [0]
+
+    def __len__(self) -> int:
+        return len(self._tree) - 1
+
+    def append(self, value: int) -> None:
+        index = len(self._tree)
+        lowest = index & -index
+        self._tree.append(value + self.prefix(index - 1))
+        self._tree[index] -= self.prefix(index - lowest)
+
+    def add(self, slot: int, value: int) -> None:
+        index = slot + 1
+        while index < len(self._tree):
+            self._tree[index] += value
+            index += index & -index
+
+    # Number of live slots before the given slot
+    def prefix(self, slot: int) -> int:
+        total = 0
+        while slot > 0:
+            total += self._tree[slot]
+            slot -= slot & -slot
+        return total
+
+    # Slot holding the live entry at the given row
+    def select(self, row: int) -> int:
+        slot = 0
+        step = 1 << len(self).bit_length()
+        while step:
+            if (
+                slot + step < len(self._tree)
+                and self._tree[slot + step] <= row
+            ):
+                slot += step
+                row -= self._tree[slot]
+            step >>= 1
+        return slot
+
+
+# Alerts keyed by id in arrival order, indexed by patient and by time
+class AlertStore:
+
+    # Dismissed slots are compacted away once they outnumber live ones
+    COMPACT_THRESHOLD = 1024
+
+    def __init__(self) -> None:
+        self._ids = itertools.count(1)
+        self.clear()
+
+    def clear(self) -> None:
+        self._alerts = {}
+        self._slots = {}
+        self._slot_ids = []
+        self._counter = SlotCounter()
+        self._by_patient = {}
+        self._by_time = []
+
+    def __len__(self) -> int:
+        return len(self._alerts)
+
+    def __iter__(self):
+        return iter(self._alerts.values())
+
+    def add(self, alert: Alert) -> int:
+        alert.id = next(self._ids)
+        self._alerts[alert.id] = alert
+
+        self._slots[alert.id] = len(self._slot_ids)
+        self._slot_ids.append(alert.id)
+        self._counter.append(1)
+
+        self._by_patient.setdefault(alert.patient.id, {})[alert.id] = alert
+        entry = (alert.timestamp, alert.id)
+        if self._by_time and entry < self._by_time[-1]:
+            bisect.insort(self._by_time, entry)
+        else:
+            self._by_time.append(entry)
+        return alert.id
+
+    def remove(self, alert_id: int) -> Alert:
+        alert = self._alerts.pop(alert_id)
+        slot = self._slots.pop(alert_id)
+        self._slot_ids[slot] = None
+        self._counter.add(slot, -1)
+
+        patient_alerts = self._by_patient[alert.patient.id]
+        del patient_alerts[alert_id]
+        if not patient_alerts:
+            del self._by_patient[alert.patient.id]
+
+        dismissed = len(self._slot_ids) - len(self._alerts)
+        if dismissed > max(len(self._alerts), self.COMPACT_THRESHOLD):
+            self._compact()
+        return alert
+
+    def get(self, alert_id: int) -> Alert:
+        return self._alerts.get(alert_id)
+
+    # Alert displayed at a row, counting only alerts not yet dismissed
+    def at(self, row: int) -> Alert:
+        if not 0 <= row < len(self._alerts):
+            raise IndexError("Alert row out of range")
+        return self._alerts[self._slot_ids[self._counter.select(row)]]
+
+    def row(self, alert_id: int) -> int:
+        return self._counter.prefix(self._slots[alert_id])
+
+    def for_patient(self, patient_id: int) -> list:
+        return list(self._by_patient.get(patient_id, {}).values())
+
+    # Alerts raised between two timestamps, oldest first
+    def between(self, start: float, end: float) -> list:
+        first = bisect.bisect_left(self._by_time, (start,))
+        last = bisect.bisect_right(self._by_time, (end, float("inf")))
+        return [
+            self._alerts[alert_id]
+            for _, alert_id in self._by_time[first:last]
+            if alert_id in self._alerts
+        ]
+
+    # Rebuild the slot and time indexes without dismissed alerts
+    def _compact(self) -> None:
+        self._slot_ids = list(self._alerts)
+        self._slots = {
+            alert_id: slot for slot, alert_id in enumerate(self._slot_ids)
+        }
+        self._counter = SlotCounter()
+        for _ in self._slot_ids:
+            self._counter.append(1)
+        self._by_time = [
+            entry for entry in self._by_time if entry[1] in self._alerts
+        ]
@@ -0,0 +1,974 @@
+import argparse
+import datetime
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import deque
+
+import numpy as np
+from client import MQTT as DeviceMQTT
+from client import LoadGenerator
+from database import (
+    HISTORY,
+    HISTORY_BUCKET,
+    JOURNAL_MODE,
+    LOCATIONS,
+    PATIENT_CACHE,
+    SYNCHRONOUS,
+    ConnectionPool,
+    DatabaseConnection,
+    TelemetryWriter,
+    distance,
+)
+from datatypes import Alert, EmergencyContact, Patient, PatientProfile
+from ingest import AsyncMQTT, ShardedMQTT
+from insert_records import (
+    PREFIX_INSERT_ALLERGY,
+    PREFIX_INSERT_EMERGENCY_CONTACT,
+    PREFIX_INSERT_PATIENT,
+)
+from metrics import METRICS
+from paho.mqtt import client as paho
+from payload import (
+    decode_acceleration,
+    encode_acceleration,
+    unpack_acceleration,
+)
+from processing import MQTT, TOPIC_PREFIX, FallDetector, HeartrateAnalyser
+from profiler import Profiler
+from transport import MemoryBus, MemoryTransport, Message
+
+# The per-id loop is timed on at most this many ids and extrapolated
+LOOP_SAMPLE = 1000
+
+
+# Build a throwaway database holding a number of generated patients
+def create_database(directory: str, patients: int) -> DatabaseConnection:
+    path = os.path.join(directory, f"patients_{patients}.sqlite")
+    open(path, "w").close()
+
+    database = DatabaseConnection(path)
+    database.rebuild()
+    database.c.executemany(
+        PREFIX_INSERT_PATIENT,
+        [
+            ["First", f"Patient{i}", f"{i} Test Street, Testing", "AB1 2CD"]
+            for i in range(patients)
+        ],
+    )
+    database.c.executemany(
+        PREFIX_INSERT_ALLERGY,
+        [[i, "Penicilin"] for i in range(1, patients + 1, 2)],
+    )
+    database.c.executemany(
+        PREFIX_INSERT_EMERGENCY_CONTACT,
+        [
+            [i, "Contact", f"Patient{i}", "Son", "+44 07700900000"]
+            for i in range(1, patients + 1)
+        ],
+    )
+    database.db.commit()
+    return database
+
+
+def timed(function, *args) -> float:
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+
+def get_patient_loop(database: DatabaseConnection, patient_ids: list) -> None:
+    for patient_id in patient_ids:
+        database.get_patient(patient_id)
+
+
+# Per-id get_patient loop against a single get_patients call, cold cache
+def benchmark_get_patients(sizes=(10, 1000, 100000)) -> None:
+    print(f"{'patients':>10} {'per-id loop':>14} {'get_patients':>14}")
+    with tempfile.TemporaryDirectory() as directory:
+        for size in sizes:
+            database = create_database(directory, size)
+            patient_ids = database.get_patient_ids()
+
+            sample = patient_ids[:LOOP_SAMPLE]
+            PATIENT_CACHE.invalidate()
+            loop = timed(get_patient_loop, database, sample)
+            loop *= len(patient_ids) / len(sample)
+
+            PATIENT_CACHE.invalidate()
+            bulk = timed(database.get_patients, patient_ids)
+
+            note = " (extrapolated)" if len(sample) < len(patient_ids) else ""
+            print(f"{size:>10} {loop:>13.3f}s {bulk:>13.3f}s{note}")
+            database.close()
+
+
+# Device traffic for patients 1-9, mostly acceleration like the real feed
+def create_messages(count: int, seed: int = 0) -> list:
+    generator = random.Random(seed)
+    messages = []
+    for _ in range(count):
+        patient_id = generator.randint(1, 9)
+        subtopic = generator.choices(
+            ["acceleration", "latitude", "longitude", "heartrate"],
+            weights=[7, 1, 1, 1],
+        )[0]
+        if subtopic == "acceleration":
+            payload = ",".join(
+                str(generator.randint(0, 3) + generator.random())
+                for _ in range(3)
+            )
+        elif subtopic == "heartrate":
+            payload = str(generator.randint(50, 80))
+        else:
+            payload = str(generator.uniform(-90, 90))
+
+        message = paho.MQTTMessage(
+            topic=f"{TOPIC_PREFIX}P?{patient_id}/{subtopic}".encode()
+        )
+        message.payload = payload.encode()
+        messages.append(message)
+    return messages
+
+
+# The string-parsing MQTT._on_message that TopicDispatcher replaced
+def legacy_on_message(mqtt: MQTT, message) -> None:
+    subtopic = message.topic.split("/")[1]
+    patient_id = int(message.topic.split("?")[1][0])
+    payload = message.payload.decode("UTF-8")
+
+    if "acceleration" in subtopic:
+        acceleration = [float(value) for value in payload.split(",")]
+        if mqtt.detector.analyse(patient_id, tuple(acceleration)):
+            mqtt.alert_coalescer.trigger(
+                patient_id, mqtt.detector.impact(patient_id)
+            )
+    elif "longitude" in subtopic:
+        mqtt.telemetry_writer.put(patient_id, "longitude", payload)
+    elif "latitude" in subtopic:
+        mqtt.telemetry_writer.put(patient_id, "latitude", payload)
+    elif "heartrate" in subtopic:
+        mqtt.telemetry_writer.put(patient_id, "heartrate", int(payload))
+
+
+def deliver(on_message, messages: list) -> None:
+    for message in messages:
+        on_message(message)
+
+
+# Messages per second through MQTT._on_message, before and after, best run
+def benchmark_on_message(count: int = 200000, repeat: int = 5) -> None:
+    messages = create_messages(count)
+    mqtt = MQTT(FallDetector(), lambda *alert: None)
+    mqtt.roster.update(range(1, 10))
+
+    for name, on_message in (
+        ("before", lambda message: legacy_on_message(mqtt, message)),
+        ("after", lambda message: mqtt._on_message(None, None, message)),
+    ):
+        elapsed = float("inf")
+        for _ in range(repeat):
+            mqtt.detector = FallDetector()
+            # Nothing drains the queue, so past the default high-water mark
+            # every update takes the drop path
+            mqtt.telemetry_writer = TelemetryWriter()
+            elapsed = min(elapsed, timed(deliver, on_message, messages))
+        print(
+            f"{name:>8}: {count / elapsed:>10,.0f} messages/s, "
+            f"{mqtt.telemetry_writer.dropped:,} telemetry updates dropped"
+        )
+
+
+# Cost per acceleration sample of parsing text and binary payloads
+def benchmark_payload(count: int = 100000) -> None:
+    generator = random.Random(0)
+    samples = [
+        [generator.randint(0, 3) + generator.random() for _ in range(3)]
+        for _ in range(count)
+    ]
+
+    text = [
+        ",".join(str(value) for value in sample).encode() for sample in samples
+    ]
+    elapsed = timed(
+        lambda: [[float(value) for value in p.split(b",")] for p in text]
+    )
+    print(f"{'text':>26}: {elapsed / count * 1e9:>8.0f} ns/sample")
+
+    for per_message in (1, 50):
+        binary = [
+            encode_acceleration(samples[i : i + per_message], i)
+            for i in range(0, count, per_message)
+        ]
+        for decode in (unpack_acceleration, decode_acceleration):
+            elapsed = timed(lambda: [decode(p) for p in binary])
+            label = f"{decode.__name__} x{per_message}"
+            print(f"{label:>26}: {elapsed / count * 1e9:>8.0f} ns/sample")
+
+
+# Wait for the subscriber to catch up with what was published
+def drain(publisher, subscriber, timeout: float) -> bool:
+    deadline = time.monotonic() + timeout
+    while subscriber.delivered < publisher.published:
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+# Resident memory in bytes, None where /proc is not available
+def resident_memory() -> int:
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def percentile(values: list, q: float) -> float:
+    return float(np.percentile(values, q)) if values else None
+
+
+# One simulated fleet feeding processing.MQTT through the fake broker
+def run_end_to_end(
+    directory: str, devices: int, duration: float, fall_rate: float
+) -> dict:
+    path = create_database(directory, devices).path
+
+    injected = {}
+    latencies = []
+
+    def on_fall(patient_id: int, timestamp: float) -> None:
+        injected.setdefault(patient_id, deque()).append(timestamp)
+
+    # Bound to Dashboard.add_alert in the real application
+    def on_alert(patient_id: int, *incident) -> None:
+        if incident[4] == "fall" and injected.get(patient_id):
+            latencies.append(time.time() - injected[patient_id].popleft())
+
+    # Devices and ingest meet on a private in-process bus
+    bus = MemoryBus()
+    subscriber = MemoryTransport(bus)
+    mqtt = MQTT(
+        FallDetector(),
+        on_alert,
+        transport=subscriber,
+        pool=ConnectionPool(path),
+    )
+    mqtt.refresh_roster()
+    threading.Thread(target=mqtt._database_thread, daemon=True).start()
+    subscriber.connect()
+    subscriber.loop_start()
+
+    publisher = MemoryTransport(bus)
+    generator = LoadGenerator(
+        DeviceMQTT(publisher),
+        devices,
+        fall_rate=fall_rate,
+        fall_callback=on_fall,
+    )
+    generator.REPORT_INTERVAL = float("inf")
+
+    memory = resident_memory()
+    start = time.perf_counter()
+    generator.run(duration)
+    backlog = subscriber.inbox.qsize()
+    drained = drain(publisher, subscriber, timeout=duration)
+    elapsed = time.perf_counter() - start
+    if memory is not None:
+        memory = resident_memory() - memory
+
+    # Let the writer finish the last batch before reading its statistics
+    time.sleep(2 * mqtt.telemetry_writer.flush_interval)
+    writer = mqtt.telemetry_writer.statistics()
+
+    return {
+        "devices": devices,
+        "duration": duration,
+        "elapsed": elapsed,
+        "published": publisher.published,
+        "delivered": subscriber.delivered,
+        "drained": drained,
+        "ingest_rate": subscriber.delivered / elapsed,
+        "backlog": backlog,
+        "generator_max_lag": generator.max_lag,
+        "falls": generator.falls,
+        "alerts": len(latencies),
+        "latency_p50": percentile(latencies, 50),
+        "latency_p99": percentile(latencies, 99),
+        "db_rows_written": writer["rows_written"],
+        "db_write_rate": writer["rows_written"] / elapsed,
+        "db_dropped": writer["dropped"],
+        "invalid_payloads": mqtt.invalid_payloads,
+        "memory_growth": memory,
+    }
+
+
+# Fall-to-alert latency and sustained ingest for growing fleets, offline
+def benchmark_end_to_end(
+    devices=(100, 1000, 5000), duration: float = 20, fall_rate: float = 60
+) -> list:
+    print(
+        f"{'devices':>8} {'ingest':>12} {'p50':>8} {'p99':>8} "
+        f"{'db writes':>12} {'memory':>10}"
+    )
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for count in devices:
+            result = run_end_to_end(directory, count, duration, fall_rate)
+            results.append(result)
+
+            p50, p99 = result["latency_p50"], result["latency_p99"]
+            memory = result["memory_growth"]
+            print(
+                f"{count:>8} {result['ingest_rate']:>8,.0f} m/s "
+                + (
+                    f"{p50:>7.2f}s {p99:>7.2f}s "
+                    if p50 is not None
+                    else f"{'-':>17} "
+                )
+                + f"{result['db_write_rate']:>8,.0f} r/s "
+                + (
+                    f"{memory / 2**20:>7.1f} MB"
+                    if memory is not None
+                    else f"{'-':>10}"
+                )
+                + ("" if result["drained"] else " (backlog not drained)")
+            )
+    return results
+
+
+# Binary acceleration windows spread over a number of patients
+def create_windows(count: int, patients: int, seed: int = 0) -> list:
+    generator = np.random.default_rng(seed)
+    samples = generator.uniform(0, 4, (count, 25, 3))
+    return [
+        Message(
+            f"{TOPIC_PREFIX}/{index % patients + 1}/acceleration",
+            encode_acceleration(window, index // patients),
+        )
+        for index, window in enumerate(samples)
+    ]
+
+
+# Acceleration windows per second through one process against ShardedMQTT
+# workers, counting until every worker has finished its share
+def benchmark_sharded(
+    count: int = 40000, patients: int = 1000, workers=(1, 2, 4)
+) -> dict:
+    messages = create_windows(count, patients)
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        path = create_database(directory, patients).path
+
+        mqtt = MQTT(FallDetector(), lambda *alert: None)
+        mqtt.roster.update(range(1, patients + 1))
+        on_message = lambda message: mqtt._on_message(None, None, message)
+        elapsed = timed(deliver, on_message, messages)
+        results["single"] = count / elapsed
+        print(f"{'single':>10}: {count / elapsed:>10,.0f} windows/s")
+
+        for shards in workers:
+            mqtt = ShardedMQTT(
+                lambda *alert: None,
+                workers=shards,
+                pool=ConnectionPool(path),
+            )
+            mqtt.roster.update(range(1, patients + 1))
+            mqtt.start_workers()
+            on_message = lambda message: mqtt._on_message(None, None, message)
+
+            start = time.perf_counter()
+            deliver(on_message, messages)
+            mqtt.stop_workers()
+            elapsed = time.perf_counter() - start
+
+            results[f"workers_{shards}"] = count / elapsed
+            label = f"{shards} workers"
+            print(f"{label:>10}: {count / elapsed:>10,.0f} windows/s")
+    return results
+
+
+# Windows with a heartrate every tenth message, through the threaded MQTT
+# and AsyncMQTT over an in-process bus until both have handled everything
+def benchmark_pipeline(
+    count: int = 40000, patients: int = 300, repeat: int = 3
+) -> dict:
+    messages = create_windows(count, patients)
+    for index in range(0, count, 10):
+        messages.insert(
+            index,
+            Message(f"{TOPIC_PREFIX}/{index % patients + 1}/heartrate", b"60"),
+        )
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        pool = ConnectionPool(create_database(directory, patients).path)
+        for name in ("threads", "asyncio"):
+            best = 0
+            for _ in range(repeat):
+                bus = MemoryBus()
+                subscriber = MemoryTransport(bus)
+                if name == "asyncio":
+                    mqtt = AsyncMQTT(
+                        FallDetector(),
+                        lambda *alert: None,
+                        transport=subscriber,
+                        pool=pool,
+                    )
+                    mqtt.begin()
+                    writer = mqtt.telemetry_writer
+                    done = lambda: (
+                        mqtt.processed >= len(messages)
+                        and writer.received >= count // 10
+                    )
+                else:
+                    mqtt = MQTT(
+                        FallDetector(),
+                        lambda *alert: None,
+                        transport=subscriber,
+                        pool=pool,
+                    )
+                    mqtt.refresh_roster()
+                    writer = mqtt.telemetry_writer
+                    threading.Thread(
+                        target=mqtt._database_thread, daemon=True
+                    ).start()
+                    subscriber.connect()
+                    subscriber.loop_start()
+                    done = lambda: (
+                        subscriber.delivered >= len(messages)
+                        and writer.received >= count // 10
+                    )
+                time.sleep(0.5)
+
+                publisher = MemoryTransport(bus)
+                start = time.perf_counter()
+                for message in messages:
+                    publisher.publish(message.topic, message.payload)
+                while not done():
+                    time.sleep(0.001)
+                best = max(best, len(messages) / (time.perf_counter() - start))
+
+                if name == "asyncio":
+                    mqtt.stop()
+                subscriber.loop_stop()
+
+            results[name] = best
+            print(f"{name:>8}: {best:>10,.0f} messages/s")
+    return results
+
+
+# Cold-cache get_patient and telemetry commits with the old connection
+# settings and no patient_id indexes, against the tuned connection
+def benchmark_sqlite(
+    patients: int = 20000, lookups: int = 1000, commits: int = 500
+) -> dict:
+    generator = random.Random(0)
+    patient_ids = generator.sample(range(1, patients + 1), lookups)
+    updates = [
+        {
+            (generator.randint(1, patients), "heartrate"): generator.randint(
+                50, 80
+            )
+            for _ in range(64)
+        }
+        for _ in range(commits)
+    ]
+
+    print(f"{'':>8} {'get_patient':>16} {'telemetry':>16}")
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for name, journal_mode, synchronous in (
+            ("before", "DELETE", "FULL"),
+            ("after", JOURNAL_MODE, SYNCHRONOUS),
+        ):
+            os.mkdir(os.path.join(directory, name))
+            database = create_database(os.path.join(directory, name), patients)
+            database.close()
+            database = DatabaseConnection(
+                database.path, journal_mode, synchronous
+            )
+            if name == "before":
+                database.c.execute(
+                    """SELECT name
+                       FROM sqlite_master
+                       WHERE type = 'index' AND sql IS NOT NULL"""
+                )
+                for (index,) in database.c.fetchall():
+                    database.c.execute(f"DROP INDEX {index}")
+
+            PATIENT_CACHE.invalidate()
+            lookup = timed(get_patient_loop, database, patient_ids)
+
+            writer = TelemetryWriter()
+            write = timed(
+                lambda: [writer.flush(database, batch) for batch in updates]
+            )
+            PATIENT_CACHE.invalidate()
+            database.close()
+
+            results[name] = {
+                "get_patient_per_second": lookups / lookup,
+                "commits_per_second": commits / write,
+                "rows_per_second": writer.rows_written / write,
+            }
+            print(
+                f"{name:>8} {lookups / lookup:>10,.0f} /s "
+                f"{writer.rows_written / write:>10,.0f} rows/s"
+            )
+    return results
+
+
+# Appends to the telemetry history in writer-sized batches spanning two
+# buckets, then reads back ten minute windows of a patient's heartrate
+def benchmark_history(
+    patients: int = 1000,
+    readings: int = 200,
+    interval: int = 30000,
+    queries: int = 2000,
+) -> dict:
+    generator = random.Random(0)
+    # Readings end a third of the way into the second bucket
+    start = 20000 * HISTORY_BUCKET - readings * interval * 2 // 3
+    rows = [
+        (patient_id, "heartrate", generator.randint(50, 80), timestamp)
+        for timestamp in range(start, start + readings * interval, interval)
+        for patient_id in range(1, patients + 1)
+    ]
+    batches = [
+        rows[index : index + TelemetryWriter.BATCH_SIZE]
+        for index in range(0, len(rows), TelemetryWriter.BATCH_SIZE)
+    ]
+    windows = [
+        (
+            generator.randint(1, patients),
+            generator.randrange(start, start + readings * interval),
+        )
+        for _ in range(queries)
+    ]
+
+    with tempfile.TemporaryDirectory() as directory:
+        database = create_database(directory, 1)
+        writer = TelemetryWriter()
+        append = timed(
+            lambda: [writer.flush(database, {}, batch) for batch in batches]
+        )
+        found = []
+        read = timed(
+            lambda: [
+                found.append(
+                    database.get_history(
+                        patient_id, "heartrate", end - 600000, end
+                    )
+                )
+                for patient_id, end in windows
+            ]
+        )
+        with database.db:
+            expire = timed(HISTORY.expire, database, float("inf"))
+        database.close()
+
+    results = {
+        "rows_per_second": len(rows) / append,
+        "queries_per_second": queries / read,
+        "rows_per_query": sum(map(len, found)) / queries,
+        "expire_seconds": expire,
+    }
+    print(
+        f"append {results['rows_per_second']:>10,.0f} rows/s\n"
+        f"  read {results['queries_per_second']:>10,.0f} queries/s, "
+        f"{results['rows_per_query']:.1f} rows each\n"
+        f"expire {expire * 1000:>10.2f} ms for {len(rows):,} rows"
+    )
+    return results
+
+
+# Stands in for the dict-backed Patient, Alert and EmergencyContact classes
+# that datatypes.py had before they were slotted
+class LegacyRecord:
+    def __init__(self, **fields) -> None:
+        self.__dict__.update(fields)
+
+
+def legacy_alert_string(alert: LegacyRecord) -> str:
+    time = datetime.datetime.utcfromtimestamp(alert.timestamp).strftime(
+        "%H:%M"
+    )
+    string = f"[{time}] - {alert.patient.firstname} {alert.patient.lastname}"
+    if alert.count > 1:
+        string += f" (x{alert.count})"
+    return string
+
+
+# A patient's columns as fresh objects, the way each database fetch makes
+def patient_row(patient_id: int) -> tuple:
+    return (
+        patient_id,
+        f"First{patient_id}",
+        f"Patient{patient_id}",
+        f"{patient_id} Test Street, Testing",
+        f"AB{patient_id % 10} 2CD",
+        [f"Allergy{patient_id}", f"Allergy{patient_id + 1}"],
+        [
+            (f"Contact{patient_id}", "Patient", "Son", f"+44 {patient_id}"),
+            (f"Contact{patient_id}", "Patient", "Wife", f"+44 {patient_id}"),
+        ],
+        60 + patient_id % 20,
+        f"{-0.1 - patient_id / 1e5:.5f}",
+        f"{51 + patient_id / 1e5:.5f}",
+    )
+
+
+def build_legacy_alert(patient_id: int, timestamp: float) -> LegacyRecord:
+    (
+        *profile,
+        allergies,
+        contacts,
+        heartrate,
+        longitude,
+        latitude,
+    ) = patient_row(patient_id)
+    patient = LegacyRecord(
+        **dict(zip(PatientProfile._fields, profile)),
+        allergies=allergies,
+        emergency_contacts=[
+            LegacyRecord(
+                firstname=contact[0],
+                lastname=contact[1],
+                relationship=contact[2],
+                phonenumber=contact[3],
+            )
+            for contact in contacts
+        ],
+        heartrate=heartrate,
+        longitude=longitude,
+        latitude=latitude,
+    )
+    return LegacyRecord(
+        id=None,
+        patient=patient,
+        timestamp=timestamp,
+        count=1,
+        last_timestamp=timestamp,
+        peak_magnitude=None,
+    )
+
+
+# Profiles come from the patient cache, one per patient
+def build_alert(profiles: dict, patient_id: int, timestamp: float) -> Alert:
+    (
+        *profile,
+        allergies,
+        contacts,
+        heartrate,
+        longitude,
+        latitude,
+    ) = patient_row(patient_id)
+    if patient_id not in profiles:
+        profiles[patient_id] = PatientProfile(
+            *profile,
+            tuple(allergies),
+            tuple(EmergencyContact(*contact) for contact in contacts),
+        )
+    return Alert(
+        Patient(profiles[patient_id], heartrate, longitude, latitude),
+        timestamp,
+    )
+
+
+# Memory held by 100k alerts across a smaller set of patients, and the time
+# to format every alert for the list a few times over
+def benchmark_datatypes(
+    alerts: int = 100000, patients: int = 1000, redraws: int = 3
+) -> dict:
+    results = {}
+    for name in ("before", "after"):
+        profiles = {}
+        tracemalloc.start()
+        if name == "before":
+            built = [
+                build_legacy_alert(index % patients + 1, 1.7e9 + index)
+                for index in range(alerts)
+            ]
+            to_string = legacy_alert_string
+        else:
+            built = [
+                build_alert(profiles, index % patients + 1, 1.7e9 + index)
+                for index in range(alerts)
+            ]
+            to_string = str
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        format_time = timed(
+            lambda records: [
+                list(map(to_string, records)) for _ in range(redraws)
+            ],
+            built,
+        )
+        results[name] = {
+            "bytes_per_alert": memory / alerts,
+            "memory_mb": memory / 1e6,
+            "format_per_second": alerts * redraws / format_time,
+        }
+        print(
+            f"{name:>8} {memory / 1e6:>8.1f} MB "
+            f"{memory / alerts:>6,.0f} B/alert "
+            f"{alerts * redraws / format_time:>10,.0f} strings/s"
+        )
+        del built
+    return results
+
+
+# Every position read from the patients table and checked, as a radius
+# search has to without the spatial index
+def scan_within(
+    database: DatabaseConnection,
+    latitude: float,
+    longitude: float,
+    radius: float,
+) -> list:
+    database.c.execute(
+        """SELECT id, latitude, longitude
+           FROM patients
+           WHERE latitude IS NOT NULL AND longitude IS NOT NULL"""
+    )
+    found = []
+    for patient_id, to_latitude, to_longitude in database.c.fetchall():
+        kilometres = distance(latitude, longitude, to_latitude, to_longitude)
+        if kilometres <= radius:
+            found.append((kilometres, patient_id))
+    found.sort()
+    return found
+
+
+# Radius and nearest-patient queries over patients spread across Great
+# Britain, scanning the table against the spatial index, and the rate the
+# index takes position updates at
+def benchmark_spatial(
+    patients: int = 100000, queries: int = 200, radius: float = 5
+) -> dict:
+    generator = random.Random(0)
+    positions = [
+        (generator.uniform(50, 58), generator.uniform(-5, 1))
+        for _ in range(patients)
+    ]
+    points = generator.sample(positions, queries)
+
+    with tempfile.TemporaryDirectory() as directory:
+        database = create_database(directory, patients)
+        with database.db:
+            database.c.executemany(
+                """UPDATE patients
+                   SET latitude = ?, longitude = ?
+                   WHERE id = ?""",
+                [
+                    (latitude, longitude, patient_id)
+                    for patient_id, (latitude, longitude) in enumerate(
+                        positions, 1
+                    )
+                ],
+            )
+
+        scan = timed(
+            lambda: [scan_within(database, *point, radius) for point in points]
+        )
+        LOCATIONS.invalidate()
+        load = timed(LOCATIONS.load, database)
+        found = []
+        within = timed(
+            lambda: [
+                found.append(database.get_patients_within(*point, radius))
+                for point in points
+            ]
+        )
+        nearest = timed(
+            lambda: [
+                database.get_nearest_patients(*point, 5) for point in points
+            ]
+        )
+        assert found[-1] == scan_within(database, *points[-1], radius)
+
+        batch = {}
+        for patient_id, (latitude, longitude) in enumerate(positions, 1):
+            batch[(patient_id, "latitude")] = latitude + 0.001
+            batch[(patient_id, "longitude")] = longitude + 0.001
+        update = timed(LOCATIONS.update, batch)
+        LOCATIONS.invalidate()
+        database.close()
+
+    results = {
+        "scan_per_second": queries / scan,
+        "within_per_second": queries / within,
+        "nearest_per_second": queries / nearest,
+        "patients_per_query": sum(map(len, found)) / queries,
+        "load_seconds": load,
+        "updates_per_second": patients / update,
+    }
+    print(
+        f"  scan {results['scan_per_second']:>10,.0f} queries/s\n"
+        f"within {results['within_per_second']:>10,.0f} queries/s, "
+        f"{results['patients_per_query']:.1f} patients each\n"
+        f"nearest {results['nearest_per_second']:>9,.0f} queries/s\n"
+        f"  load {load * 1000:>10.0f} ms for {patients:,} patients\n"
+        f"update {results['updates_per_second']:>10,.0f} positions/s"
+    )
+    return results
+
+
+# Readings per second through HeartrateAnalyser for a fleet at rest, with
+# spikes to 150-180 BPM injected once baselines are warm, and how many of
+# those spikes and of the resting readings raised an alert
+def benchmark_heartrate(
+    readings: int = 1000000, patients: int = 10000, spikes: int = 1000
+) -> dict:
+    generator = random.Random(0)
+    values = [generator.randint(50, 80) for _ in range(readings)]
+    spikes = set(generator.sample(range(patients * 40, readings), spikes))
+    for index in spikes:
+        values[index] = generator.randint(150, 180)
+
+    analyser = HeartrateAnalyser(lambda *alert: None)
+    anomalous = []
+    elapsed = timed(
+        lambda: [
+            anomalous.append(
+                analyser.update(index % patients, value, index * 0.001)
+            )
+            for index, value in enumerate(values)
+        ]
+    )
+
+    caught = sum(anomalous[index] for index in spikes)
+    results = {
+        "readings_per_second": readings / elapsed,
+        "spikes_caught": caught / len(spikes),
+        "false_alerts": sum(anomalous) - caught,
+    }
+    print(
+        f"{results['readings_per_second']:>10,.0f} readings/s, "
+        f"{caught}/{len(spikes)} spikes caught, "
+        f"{results['false_alerts']} false alerts"
+    )
+    return results
+
+
+# Messages per second through MQTT._on_message with instrumentation off,
+# as it normally runs, and on
+def benchmark_metrics(count: int = 200000, repeat: int = 5) -> dict:
+    messages = create_messages(count)
+    results = {}
+    for name in ("off", "on"):
+        if name == "on":
+            METRICS.enable()
+        elapsed = float("inf")
+        for _ in range(repeat):
+            mqtt = MQTT(
+                FallDetector(),
+                lambda *alert: None,
+                transport=MemoryTransport(MemoryBus()),
+            )
+            mqtt.roster.update(range(1, 10))
+            elapsed = min(
+                elapsed,
+                timed(
+                    deliver,
+                    lambda message: mqtt._on_message(None, None, message),
+                    messages,
+                ),
+            )
+        results[name] = count / elapsed
+        print(f"{name:>8}: {count / elapsed:>10,.0f} messages/s")
+
+    METRICS.enabled = False
+    print(METRICS.summary())
+    return results
+
+
+def benchmark_profiler(count: int = 200000, repeat: int = 5) -> dict:
+    messages = create_messages(count)
+    profiler = Profiler()
+    results = {}
+    for name in ("off", "on"):
+        if name == "on":
+            profiler.start()
+        elapsed = float("inf")
+        for _ in range(repeat):
+            mqtt = MQTT(
+                FallDetector(),
+                lambda *alert: None,
+                transport=MemoryTransport(MemoryBus()),
+            )
+            mqtt.roster.update(range(1, 10))
+            elapsed = min(
+                elapsed,
+                timed(
+                    deliver,
+                    lambda message: mqtt._on_message(None, None, message),
+                    messages,
+                ),
+            )
+        results[name] = count / elapsed
+        print(f"{name:>8}: {count / elapsed:>10,.0f} messages/s")
+
+    with tempfile.TemporaryDirectory() as directory:
+        profiler.write(os.path.join(directory, "profile.folded"))
+    return results
+
+
+BENCHMARKS = {
+    "get_patients": benchmark_get_patients,
+    "on_message": benchmark_on_message,
+    "payload": benchmark_payload,
+    "end_to_end": benchmark_end_to_end,
+    "sharded": benchmark_sharded,
+    "pipeline": benchmark_pipeline,
+    "sqlite": benchmark_sqlite,
+    "history": benchmark_history,
+    "datatypes": benchmark_datatypes,
+    "spatial": benchmark_spatial,
+    "heartrate": benchmark_heartrate,
+    "metrics": benchmark_metrics,
+    "profiler": benchmark_profiler,
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fall detector benchmarks")
+    parser.add_argument("names", nargs="*", choices=[[]] + list(BENCHMARKS))
+    parser.add_argument(
+        "--devices", type=int, nargs="+", help="end_to_end fleet sizes"
+    )
+    parser.add_argument("--duration", type=float, help="end_to_end seconds")
+    parser.add_argument(
+        "--fall-rate", type=float, help="end_to_end falls per device per hour"
+    )
+    parser.add_argument("--output", help="write results to this JSON file")
+    arguments = parser.parse_args()
+
+    options = {
+        "end_to_end": {
+            option: value
+            for option, value in (
+                ("devices", arguments.devices),
+                ("duration", arguments.duration),
+                ("fall_rate", arguments.fall_rate),
+            )
+            if value is not None
+        }
+    }
+
+    results = {}
+    for name in arguments.names or list(BENCHMARKS):
+        print(f"== {name} ==")
+        result = BENCHMARKS[name](**options.get(name, {}))
+        if result is not None:
+            results[name] = result
+
+    if arguments.output:
+        with open(arguments.output, "w") as output:
+            json.dump(results, output, indent=2)
@@ -1,24 +1,28 @@
+import argparse
+import heapq
 import random
 import threading
 import time
 import tkinter as tk
+from collections import deque
 from tkinter import font, ttk
 
-from paho.mqtt import client as paho
+from payload import encode_acceleration
+from transport import TOPIC_PREFIX, PahoTransport
 
-BROKER_URL = "broker.mqttdashboard.com"
-BROKER_PORT = 1883
-
-TOPIC_PREFIX = "BS2203FD"
+# Send acceleration as "x,y,z" text like older devices, instead of binary
+TEXT_PAYLOADS = False
 
 
 class MQTT:
-    def __init__(self) -> None:
-        self.client = paho.Client()
+    # legacy_topics publishes to the older "<prefix>P?<patient id>" layout
+    def __init__(self, transport=None, legacy_topics: bool = False) -> None:
+        self.client = transport or PahoTransport()
         self.client.on_publish = self._on_publish
+        self.legacy_topics = legacy_topics
 
     def begin(self):
-        self.client.connect(BROKER_URL, BROKER_PORT)
+        self.client.connect()
         self.client.loop_start()
 
     def _on_publish(self, client, userdata, mid):
@@ -26,10 +30,75 @@ class MQTT:
         pass
 
     def publish(self, patient_id: str, subtopic: str, payload: str):
-        topic = f"{TOPIC_PREFIX}P?{patient_id}/{subtopic}"
+        if self.legacy_topics:
+            topic = f"{TOPIC_PREFIX}P?{patient_id}/{subtopic}"
+        else:
+            topic = f"{TOPIC_PREFIX}/{patient_id}/{subtopic}"
         self.client.publish(topic, payload)
 
 
+# Device behaviour without any Tk, shared by the GUI and headless modes
+class DeviceSimulator:
+    def __init__(
+        self,
+        patient_id: int,
+        seed=None,
+        latitude: float = None,
+        longitude: float = None,
+    ) -> None:
+        self.patient_id = patient_id
+        self.random = random.Random(seed)
+        self.sequence = 0
+        self.latitude = latitude
+        self.longitude = longitude
+
+        self._next_acceleration_values = deque()
+        self._raised_heartrates = 0
+
+    def next_sample(self) -> list:
+        if self._next_acceleration_values:
+            return self._next_acceleration_values.popleft()
+        return [
+            self.random.randint(0, 3) + self.random.random() for i in range(3)
+        ]
+
+    # One binary payload per window, or one text payload per sample
+    def acceleration_payloads(self) -> list:
+        samples = [
+            self.next_sample() for i in range(Dashboard.SAMPLES_PER_MESSAGE)
+        ]
+        self.sequence += 1
+
+        if TEXT_PAYLOADS:
+            return [
+                ",".join(str(value) for value in sample) for sample in samples
+            ]
+        return [encode_acceleration(samples, self.sequence)]
+
+    # Resting, or raised for a few readings after a fall
+    def heartrate(self) -> int:
+        if self._raised_heartrates:
+            self._raised_heartrates -= 1
+            return self.random.randint(130, 170)
+        return self.random.randint(50, 80)
+
+    # Wander a few metres from the last reported location
+    def walk(self) -> tuple:
+        self.latitude += self.random.uniform(-0.0001, 0.0001)
+        self.longitude += self.random.uniform(-0.0001, 0.0001)
+        return self.latitude, self.longitude
+
+    def simulate_fall(self) -> None:
+        # Free fall for 0.3s, then an impact, then lying still for 3s
+        rate = Dashboard.SAMPLE_RATE
+        self._next_acceleration_values.extend(
+            [(0.1, 0.1, 0.2)] * max(1, round(0.3 * rate))
+            + [(10, 10, 10)]
+            + [(0.0, 0.1, 1.0)] * round(3 * rate)
+        )
+        self._raised_heartrates = 3
+
+
 class Device(ttk.LabelFrame):
     def __init__(
         self, root: tk.Tk, device_id: int, client: MQTT, *args, **kwargs
@@ -40,7 +109,7 @@ class Device(ttk.LabelFrame):
         self._device_id = device_id
         self._state = False
 
-        self._next_acceleration_value = None
+        self._simulator = DeviceSimulator(device_id)
 
         # Tk Display Variables
         self._variable_patient_id = tk.StringVar(value=device_id)
@@ -100,30 +169,24 @@ class Device(ttk.LabelFrame):
         self._widgets[6].grid(row=4, column=0, sticky="W", padx=4, pady=5)
         self._widgets[7].grid(row=4, column=1, sticky="W", padx=4, pady=5)
 
+    # Sample at SAMPLE_RATE, publishing SAMPLES_PER_MESSAGE samples at a time
     def _publish_acceleration(self):
+        period = Dashboard.SAMPLES_PER_MESSAGE / Dashboard.SAMPLE_RATE
         while True:
+            next_publish = time.monotonic()
             while self._state:
-                if self._next_acceleration_value is None:
-                    payload = ",".join(
-                        [
-                            str(random.randint(0, 3) + random.random())
-                            for i in range(3)
-                        ]
-                    )
-                else:
-                    payload = self._next_acceleration_value
-                    self._next_acceleration_value = None
+                patient_id = self._variable_patient_id.get()
+                for payload in self._simulator.acceleration_payloads():
+                    self._client.publish(patient_id, "acceleration", payload)
 
-                self._client.publish(
-                    self._variable_patient_id.get(), "acceleration", payload
-                )
-                time.sleep(1)
+                next_publish += period
+                time.sleep(max(0, next_publish - time.monotonic()))
             time.sleep(Dashboard.ACC_INTERVAL)
 
     def _publish_heartrate(self):
         while True:
             while self._state:
-                payload = random.randint(50, 80)
+                payload = self._simulator.heartrate()
                 self._variable_heartrate.set(
                     f"Reported Heartrate: {payload} BPM"
                 )
@@ -161,7 +224,7 @@ class Device(ttk.LabelFrame):
         )
 
     def _simulate_fall(self):
-        self._next_acceleration_value = "10,10,10"
+        self._simulator.simulate_fall()
 
 
 class Dashboard(tk.Tk):
@@ -169,6 +232,8 @@ class Dashboard(tk.Tk):
     DEVICES = 4
 
     ACC_INTERVAL = 1
+    SAMPLE_RATE = 50
+    SAMPLES_PER_MESSAGE = 25
     HEARTRATE_INTERVAL = 5
     LOCATION_INTERVAL = 30
 
@@ -222,10 +287,174 @@ class Dashboard(tk.Tk):
         self.mainloop()
 
 
+# Drives many simulated devices from one thread with a timer heap, in place
+# of three threads per device
+class LoadGenerator:
+
+    ACCELERATION, HEARTRATE, LOCATION = range(3)
+
+    # Falls injected per device per hour
+    FALL_RATE = 1.0
+    REPORT_INTERVAL = 10
+
+    # Devices start scattered around this point
+    LATITUDE = 51.5
+    LONGITUDE = -0.12
+
+    def __init__(
+        self,
+        client: MQTT,
+        devices: int,
+        seed: int = 0,
+        fall_rate: float = FALL_RATE,
+        heartrate_interval: float = None,
+        location_interval: float = None,
+        first_patient: int = 1,
+        fall_callback=None,
+    ) -> None:
+        self._client = client
+        self.fall_callback = fall_callback
+
+        self.intervals = [
+            Dashboard.SAMPLES_PER_MESSAGE / Dashboard.SAMPLE_RATE,
+            heartrate_interval or Dashboard.HEARTRATE_INTERVAL,
+            location_interval or Dashboard.LOCATION_INTERVAL,
+        ]
+        self.fall_probability = fall_rate * self.intervals[0] / 3600
+
+        # Each device has its own seeded generator so runs repeat exactly
+        generator = random.Random(seed)
+        self.devices = [
+            DeviceSimulator(
+                first_patient + i,
+                seed=f"{seed}:{i}",
+                latitude=self.LATITUDE + generator.uniform(-0.5, 0.5),
+                longitude=self.LONGITUDE + generator.uniform(-0.5, 0.5),
+            )
+            for i in range(devices)
+        ]
+
+        # Stagger devices across each interval rather than firing together
+        self._schedule = [
+            (generator.uniform(0, interval), kind, index)
+            for index in range(devices)
+            for kind, interval in enumerate(self.intervals)
+        ]
+        heapq.heapify(self._schedule)
+
+        self._stop = threading.Event()
+        self.published = 0
+        self.falls = 0
+        self.max_lag = 0.0
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def run(self, duration: float = None) -> None:
+        start = time.monotonic()
+        end = None if duration is None else start + duration
+        next_report = start + self.REPORT_INTERVAL
+
+        while not self._stop.is_set():
+            due, kind, index = self._schedule[0]
+            due += start
+            now = time.monotonic()
+            if end is not None and now >= end:
+                break
+            if due > now:
+                self._stop.wait(min(due, end or due) - now)
+                continue
+
+            self.max_lag = max(self.max_lag, now - due)
+            heapq.heapreplace(
+                self._schedule,
+                (due - start + self.intervals[kind], kind, index),
+            )
+            self._emit(kind, self.devices[index])
+
+            if now >= next_report:
+                self.report(now - start)
+                next_report += self.REPORT_INTERVAL
+
+    def _emit(self, kind: int, device: DeviceSimulator) -> None:
+        if kind == LoadGenerator.ACCELERATION:
+            if device.random.random() < self.fall_probability:
+                device.simulate_fall()
+                self.falls += 1
+                if self.fall_callback is not None:
+                    self.fall_callback(device.patient_id, time.time())
+
+            for payload in device.acceleration_payloads():
+                self._client.publish(
+                    device.patient_id, "acceleration", payload
+                )
+                self.published += 1
+
+        elif kind == LoadGenerator.HEARTRATE:
+            self._client.publish(
+                device.patient_id, "heartrate", device.heartrate()
+            )
+            self.published += 1
+
+        else:
+            latitude, longitude = device.walk()
+            self._client.publish(
+                device.patient_id, "latitude", f"{latitude:.5f}"
+            )
+            self._client.publish(
+                device.patient_id, "longitude", f"{longitude:.5f}"
+            )
+            self.published += 2
+
+    def report(self, elapsed: float) -> None:
+        print(
+            f"Load: {len(self.devices)} devices, {self.published} messages "
+            f"({self.published / elapsed:.0f}/s), {self.falls} falls, "
+            f"max lag {self.max_lag * 1000:.0f} ms"
+        )
+
+
 if __name__ == "__main__":
-    client = MQTT()
+    parser = argparse.ArgumentParser(description="BS2203 client simulator")
+    parser.add_argument(
+        "--headless",
+        type=int,
+        metavar="DEVICES",
+        help="simulate this many devices without a window",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--fall-rate",
+        type=float,
+        default=LoadGenerator.FALL_RATE,
+        help="falls injected per device per hour",
+    )
+    parser.add_argument("--heartrate-interval", type=float)
+    parser.add_argument("--location-interval", type=float)
+    parser.add_argument("--first-patient", type=int, default=1)
+    parser.add_argument("--duration", type=float, help="seconds to run for")
+    parser.add_argument(
+        "--legacy-topics",
+        action="store_true",
+        help="publish to the older <prefix>P?<patient id> topics",
+    )
+    arguments = parser.parse_args()
+
+    client = MQTT(legacy_topics=arguments.legacy_topics)
     client.begin()
 
-    dashboard = Dashboard(client)
+    if arguments.headless:
+        generator = LoadGenerator(
+            client,
+            arguments.headless,
+            seed=arguments.seed,
+            fall_rate=arguments.fall_rate,
+            heartrate_interval=arguments.heartrate_interval,
+            location_interval=arguments.location_interval,
+            first_patient=arguments.first_patient,
+        )
+        generator.run(arguments.duration)
+    else:
+        dashboard = Dashboard(client)
 
-    dashboard.show()
+        dashboard.show()
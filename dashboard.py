@@ -1,15 +1,27 @@
+import argparse
+import datetime
 import queue
 import threading
 import time
 import tkinter as tk
 from tkinter import font, messagebox, ttk
 
-from database import DatabaseConnection
+import client as simulator
+from alerts import AlertStore
+from database import POOL
 from datatypes import Alert
+from ingest import AsyncMQTT, ShardedMQTT
+from metrics import LOG_INTERVAL, METRICS, METRICS_PORT
 from processing import MQTT, FallDetector
+from profiler import PROFILE_INTERVAL, Profiler
+from transport import MemoryTransport
 
 
 class Sidebar(ttk.LabelFrame):
+
+    # Seconds of telemetry history shown from before a fall
+    HISTORY_WINDOW = 10 * 60
+
     def __init__(self, *args, **kwargs) -> None:
         super().__init__(*args, **kwargs)
 
@@ -70,7 +82,11 @@ class Sidebar(ttk.LabelFrame):
         for i, widget in enumerate(self._widgets):
             widget.grid(column=0, row=i, sticky="NESW")
 
-    def set_alert(self, alert: Alert) -> None:
+    # Heartrates are (timestamp, value) and the trail (timestamp, latitude,
+    # longitude) from the history, since HISTORY_WINDOW before the fall
+    def set_alert(
+        self, alert: Alert, heartrates: list = (), trail: list = ()
+    ) -> None:
         self._variable_name.set(
             f"{alert.patient.firstname} {alert.patient.lastname}"
         )
@@ -82,18 +98,44 @@ class Sidebar(ttk.LabelFrame):
             )
         else:
             self._variable_location_type.set("Location:")
-            self._variable_location.set(
-                f"Lon: {alert.patient.longitude}, Lat: {alert.patient.latitude}"
+            location = (
+                f"Lon: {alert.patient.longitude:.5f}, "
+                f"Lat: {alert.patient.latitude:.5f}"
             )
+            if trail:
+                _, latitude, longitude = trail[0]
+                location += f"\n{len(trail)} positions since "
+                location += f"Lon: {longitude:.5f}, Lat: {latitude:.5f}"
+            self._variable_location.set(location)
 
         if alert.patient.heartrate is not None:
-            self._variable_heartrate.set(f"{alert.patient.heartrate} BPM")
+            heartrate = f"{alert.patient.heartrate} BPM"
         else:
-            self._variable_heartrate.set("- BPM")
-
-        self._variable_time_of_fall.set(
-            alert.get_datetime_object().strftime("%d/%m/%Y at %I:%M %p")
+            heartrate = "- BPM"
+        if heartrates:
+            values = [value for _, value in heartrates]
+            heartrate += f"\n{min(values):.0f} to {max(values):.0f} BPM "
+            heartrate += f"over {len(values)} readings"
+        self._variable_heartrate.set(heartrate)
+
+        time_of_fall = alert.get_datetime_object().strftime(
+            "%d/%m/%Y at %I:%M %p"
         )
+        if alert.kind == "heartrate":
+            self._widgets[6].configure(text="Time of Heartrate Alert:")
+            time_of_fall += f"\n{alert.peak_magnitude:.0f} BPM from normal"
+        elif alert.kind == "geofence":
+            self._widgets[6].configure(text="Time of Geofence Exit:")
+            time_of_fall += f"\n{alert.peak_magnitude:.2f} km from its centre"
+        else:
+            self._widgets[6].configure(text="Time of Fall:")
+        if alert.severity > 1:
+            time_of_fall += "\nShortly after a fall"
+        if alert.count > 1:
+            last = datetime.datetime.utcfromtimestamp(alert.last_timestamp)
+            time_of_fall += f"\n{alert.count} triggers, "
+            time_of_fall += f"last at {last.strftime('%I:%M:%S %p')}"
+        self._variable_time_of_fall.set(time_of_fall)
 
         self._variable_alergies.set(alert.patient.allergies)
         self._variable_emergency_contacts.set(
@@ -105,14 +147,148 @@ class Sidebar(ttk.LabelFrame):
         self._variable_location_type.set("Address:")
         self._variable_location.set("")
         self._variable_time_of_fall.set("")
+        self._widgets[6].configure(text="Time of Fall:")
         self._variable_alergies.set("")
         self._variable_emergency_contacts.set("")
 
 
+# Listbox that only holds, and only formats, the rows currently in view
+class AlertList(ttk.Frame):
+    def __init__(
+        self, root, alerts: AlertStore, on_select, *args, **kwargs
+    ) -> None:
+        super().__init__(root, *args, **kwargs)
+
+        self._alerts = alerts
+        self._on_select = on_select
+        self._offset = 0
+        self._selected_id = None
+
+        self.listbox = tk.Listbox(self, exportselection=False)
+        self._scrollbar = ttk.Scrollbar(self, command=self._on_scroll)
+
+        self.listbox.grid(column=0, row=0, sticky="NESW")
+        self._scrollbar.grid(column=1, row=0, sticky="NS")
+
+        self.listbox.bind("<<ListboxSelect>>", self._on_listbox_select)
+        self.listbox.bind("<MouseWheel>", self._on_mousewheel)
+        self.listbox.bind("<Button-4>", lambda event: self.scroll(-1))
+        self.listbox.bind("<Button-5>", lambda event: self.scroll(1))
+        for key, rows in (("<Up>", -1), ("<Down>", 1)):
+            self.listbox.bind(key, lambda event, rows=rows: self._step(rows))
+
+    def _rows(self) -> int:
+        return int(self.listbox.cget("height"))
+
+    def selected(self) -> Alert:
+        if self._selected_id is None:
+            return None
+        return self._alerts.get(self._selected_id)
+
+    # Show a newly stored alert, formatting it only if it lands in view
+    def append(self, alert: Alert) -> None:
+        row = len(self._alerts) - 1
+        if self._offset <= row < self._offset + self._rows():
+            self.listbox.insert("end", str(alert))
+        self._update_scrollbar()
+
+    # Reformat a single alert's row if it is in view
+    def refresh_alert(self, alert: Alert) -> None:
+        index = self._alerts.row(alert.id) - self._offset
+        if 0 <= index < self.listbox.size():
+            self.listbox.delete(index)
+            self.listbox.insert(index, str(alert))
+            if alert.id == self._selected_id:
+                self.listbox.selection_set(index)
+
+    # Redraw the rows in view, after dismissals or scrolling
+    def refresh(self) -> None:
+        if self._selected_id is not None and self.selected() is None:
+            self._selected_id = None
+        self._offset = max(
+            0, min(self._offset, len(self._alerts) - self._rows())
+        )
+
+        rows = []
+        selection = None
+        for row in range(
+            self._offset, min(self._offset + self._rows(), len(self._alerts))
+        ):
+            alert = self._alerts.at(row)
+            if alert.id == self._selected_id:
+                selection = len(rows)
+            rows.append(str(alert))
+
+        self.listbox.delete(0, "end")
+        if rows:
+            self.listbox.insert("end", *rows)
+        if selection is not None:
+            self.listbox.selection_set(selection)
+        self._update_scrollbar()
+
+    def scroll(self, rows: int) -> str:
+        last = max(0, len(self._alerts) - self._rows())
+        offset = max(0, min(self._offset + rows, last))
+        if offset != self._offset:
+            self._offset = offset
+            self.refresh()
+        return "break"
+
+    def _update_scrollbar(self) -> None:
+        total = max(len(self._alerts), 1)
+        self._scrollbar.set(
+            self._offset / total,
+            min(self._offset + self._rows(), total) / total,
+        )
+
+    def _on_scroll(self, action: str, amount: str, unit: str = None) -> None:
+        if action == "moveto":
+            self.scroll(
+                round(float(amount) * len(self._alerts)) - self._offset
+            )
+        elif unit == "pages":
+            self.scroll(int(amount) * self._rows())
+        else:
+            self.scroll(int(amount))
+
+    def _on_mousewheel(self, event) -> str:
+        return self.scroll(-1 if event.delta > 0 else 1)
+
+    # Move the selection with the keyboard, scrolling at the edges
+    def _step(self, rows: int) -> str:
+        alert = self.selected()
+        row = 0 if alert is None else self._alerts.row(alert.id) + rows
+        if not 0 <= row < len(self._alerts):
+            return "break"
+
+        if row < self._offset:
+            self.scroll(row - self._offset)
+        elif row >= self._offset + self._rows():
+            self.scroll(row - self._offset - self._rows() + 1)
+
+        self._selected_id = self._alerts.at(row).id
+        self.listbox.selection_clear(0, "end")
+        self.listbox.selection_set(row - self._offset)
+        self._on_select()
+        return "break"
+
+    def _on_listbox_select(self, event=None) -> None:
+        try:
+            row = self._offset + self.listbox.curselection()[0]
+            self._selected_id = self._alerts.at(row).id
+        except IndexError:
+            self._selected_id = None
+        self._on_select()
+
+
 class Dashboard(tk.Tk):
-    def __init__(self) -> None:
+
+    EVENT = "<<Synchronise>>"
+
+    def __init__(self, profiler: Profiler = None) -> None:
         super().__init__()
         self.title("BS2203 - Operator Dashboard")
+        self._profiler = profiler
 
         # Overwrite Default Font
         font_ = font.nametofont("TkDefaultFont")
@@ -128,17 +304,24 @@ class Dashboard(tk.Tk):
         self.style.configure("Accent.TFrame", background="#00A6FF")
 
         # Window Variables
-        self._alerts_buffer = []
-        self._alerts_queue = queue.Queue()
-
-        # Tk Display Variables
-        self._variable_alerts = tk.StringVar()
+        self._alerts = AlertStore()
+        self._events = queue.Queue()
+        self._event_pending = False
 
         # Window Construction
         self._construct()
         self._stylize()
         self._pack()
 
+        self._synchronise = METRICS.timed(
+            "dashboard_synchronise_seconds",
+            "Time to apply queued alerts and telemetry on the Tk loop",
+            self._synchronise,
+        )
+
+        # Updates from other threads are applied by the Tk main loop
+        self.bind(Dashboard.EVENT, self._synchronise)
+
     def _construct(self) -> None:
         # Menu Bar
         self._menubar = tk.Menu(self, bg="#FFFFFF", activebackground="#00A6FF")
@@ -150,6 +333,11 @@ class Dashboard(tk.Tk):
             self._menubar, tearoff=0, bg="#FFFFFF", activebackground="#00A6FF"
         )
 
+        if self._profiler is not None:
+            file_menu.add_command(
+                label="Write Profile", command=self._profiler.request_write
+            )
+            file_menu.add_separator()
         file_menu.add_command(label="Quit", command=self._quit)
         edit_menu.add_command(
             label="Dismiss Selected Alert", command=self._remove_alert
@@ -170,14 +358,14 @@ class Dashboard(tk.Tk):
         # Widgets
         self._widgets = [
             ttk.Label(self._left_frame, text="Patient Alerts"),
-            tk.Listbox(self._left_frame, listvariable=self._variable_alerts),
+            AlertList(self._left_frame, self._alerts, self._on_select),
         ]
 
     def _stylize(self) -> None:
         self._widgets[0].configure(
             font=font.Font(family="Noto Sans", size=14, weight="bold")
         )
-        self._widgets[1].configure(
+        self._widgets[1].listbox.configure(
             width=95, height=30, borderwidth=0, relief="solid"
         )
 
@@ -189,29 +377,101 @@ class Dashboard(tk.Tk):
         self._left_frame.grid(column=0, row=0, sticky="NESW", padx=7, pady=12)
         self._sidebar.grid(column=1, row=0, sticky="NESW", padx=7, pady=12)
 
-    def _synchronise(self) -> None:
-        database = DatabaseConnection()
+    # Queue an update and wake the Tk main loop, safe from any thread
+    def _post(self, kind: str, value) -> None:
+        self._events.put((kind, value))
+        if self._event_pending:
+            return
+
+        self._event_pending = True
+        try:
+            self.event_generate(Dashboard.EVENT, when="tail")
+        except (RuntimeError, tk.TclError):
+            # The main loop is not running yet, show() drains the queue
+            self._event_pending = False
+
+    # Apply queued updates, runs on the Tk main loop
+    def _synchronise(self, event=None) -> None:
+        self._event_pending = False
+
+        triggers = []
+        changed_patients = set()
         while True:
             try:
-                index = self._widgets[1].curselection()[0]
-                self._sidebar.set_alert(self._alerts_buffer[index])
-            except IndexError:
-                self._sidebar.clear()
-
-            if not self._alerts_queue.empty():
-                patient = database.get_patient(
-                    self._alerts_queue.get(timeout=1)
+                kind, value = self._events.get_nowait()
+            except queue.Empty:
+                break
+            if kind == "alert":
+                triggers.append(value)
+            elif kind == "telemetry":
+                changed_patients.update(value)
+
+        # Only patients with a brand new alert need to be fetched
+        new_patients = [
+            trigger[0]
+            for trigger in triggers
+            if self._find_alert(trigger[0], trigger[1], trigger[5]) is None
+        ]
+        with POOL.reader() as database:
+            patients = database.get_patients(new_patients)
+
+        for trigger in triggers:
+            patient_id, timestamp, last, count, peak, kind, severity = trigger
+            alert = self._find_alert(patient_id, timestamp, kind)
+            if alert is not None:
+                alert.last_timestamp = last
+                alert.count = count
+                alert.peak_magnitude = peak
+                alert.severity = severity
+                self._widgets[1].refresh_alert(alert)
+                changed_patients.add(patient_id)
+            elif patient_id in patients:
+                alert = Alert(
+                    patients[patient_id],
+                    timestamp,
+                    count=count,
+                    last_timestamp=last,
+                    peak_magnitude=peak,
+                    kind=kind,
+                    severity=severity,
                 )
-                self._alerts_buffer.append(Alert(patient, time.time()))
-
-            self._variable_alerts.set(
-                [str(alert) for alert in self._alerts_buffer]
+                self._alerts.add(alert)
+                self._widgets[1].append(alert)
+
+        selected = self._widgets[1].selected()
+        if selected is not None and selected.patient.id in changed_patients:
+            self._show_alert(selected)
+
+    # The open alert for a patient's incident, identified by its kind and
+    # first trigger
+    def _find_alert(
+        self, patient_id: int, timestamp: float, kind: str = "fall"
+    ) -> Alert:
+        for alert in self._alerts.for_patient(patient_id):
+            if alert.timestamp == timestamp and alert.kind == kind:
+                return alert
+        return None
+
+    # Refresh the alert's patient from the cache and display it
+    def _show_alert(self, alert: Alert) -> None:
+        if alert is None:
+            self._sidebar.clear()
+            return
+
+        start = int((alert.timestamp - Sidebar.HISTORY_WINDOW) * 1000)
+        end = time.time_ns() // 1000000
+        with POOL.reader() as database:
+            patient = database.get_patient(alert.patient.id)
+            heartrates = database.get_history(
+                alert.patient.id, "heartrate", start, end
             )
+            trail = database.get_location_trail(alert.patient.id, start, end)
+        if patient is not None:
+            alert.patient = patient
+        self._sidebar.set_alert(alert, heartrates, trail)
 
-            for alert in self._alerts_buffer:
-                alert.patient = database.get_patient(alert.patient.id)
-
-            time.sleep(0.3)
+    def _on_select(self) -> None:
+        self._show_alert(self._widgets[1].selected())
 
     def _quit(self) -> None:
         if messagebox.askyesno(
@@ -220,28 +480,153 @@ class Dashboard(tk.Tk):
             self.quit()
 
     def _remove_alert(self) -> None:
-        try:
-            index = self._widgets[1].curselection()[0]
-            self._alerts_buffer.pop(index)
-        except IndexError:
+        alert = self._widgets[1].selected()
+        if alert is None:
             messagebox.showerror("Dashboard", "No alert selected")
+            return
+
+        self._alerts.remove(alert.id)
+        self._widgets[1].refresh()
+        self._sidebar.clear()
 
     def _clear_alerts(self) -> None:
-        self._alerts_buffer.clear()
+        self._alerts.clear()
+        self._widgets[1].refresh()
+        self._sidebar.clear()
 
     def show(self) -> None:
-        threading.Thread(target=self._synchronise, daemon=True).start()
+        # Pick up anything that arrived before the main loop started
+        self.after_idle(self._synchronise)
         self.mainloop()
 
-    def add_alert(self, patient_id: int) -> None:
-        print(f"Alert for patient: {patient_id}")
-        self._alerts_queue.put(patient_id)
+    # Create or update the alert for an incident that began at timestamp
+    def add_alert(
+        self,
+        patient_id: int,
+        timestamp: float = None,
+        last_timestamp: float = None,
+        count: int = 1,
+        peak_magnitude: float = None,
+        kind: str = "fall",
+        severity: int = 1,
+    ) -> None:
+        if timestamp is None:
+            timestamp = time.time()
+        if last_timestamp is None:
+            last_timestamp = timestamp
+
+        if count == 1:
+            print(f"Alert for patient: {patient_id} ({kind})")
+        self._post(
+            "alert",
+            (
+                patient_id,
+                timestamp,
+                last_timestamp,
+                count,
+                peak_magnitude,
+                kind,
+                severity,
+            ),
+        )
+
+    # Called by the telemetry writer with the patients it just committed
+    def update_telemetry(self, patient_ids: set) -> None:
+        self._post("telemetry", patient_ids)
 
 
 if __name__ == "__main__":
-    dashboard = Dashboard()
-
-    client = MQTT(FallDetector.analyse, dashboard.add_alert)
+    parser = argparse.ArgumentParser(description="BS2203 fall dashboard")
+    parser.add_argument(
+        "--simulate",
+        type=int,
+        metavar="DEVICES",
+        help="run simulated devices in-process instead of using the broker",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="shard patients across this many ingest processes",
+    )
+    parser.add_argument(
+        "--legacy-topics",
+        action="store_true",
+        help="also subscribe to older devices' <prefix>P?<patient id> "
+        "topics, one subscription per patient",
+    )
+    parser.add_argument(
+        "--asyncio",
+        action="store_true",
+        help="run ingest as an asyncio pipeline, in this process only",
+    )
+    parser.add_argument(
+        "--metrics",
+        type=int,
+        nargs="?",
+        const=METRICS_PORT,
+        metavar="PORT",
+        help="serve Prometheus metrics on localhost and log a summary",
+    )
+    parser.add_argument(
+        "--metrics-interval",
+        type=float,
+        default=LOG_INTERVAL,
+        help="seconds between metrics log lines",
+    )
+    parser.add_argument(
+        "--profile",
+        type=float,
+        nargs="?",
+        const=PROFILE_INTERVAL,
+        metavar="SECONDS",
+        help="sample thread stacks at this interval, written as collapsed "
+        "stacks from File > Write Profile or on SIGUSR1",
+    )
+    arguments = parser.parse_args()
+    if arguments.workers > 1 and arguments.asyncio:
+        parser.error("--asyncio runs in one process, it can't use --workers")
+
+    # Instrumentation is added as the pipeline is built, so before that
+    if arguments.metrics is not None:
+        METRICS.enable()
+        METRICS.serve(arguments.metrics)
+        METRICS.log_periodically(arguments.metrics_interval)
+
+    profiler = None
+    if arguments.profile is not None:
+        profiler = Profiler(arguments.profile)
+        profiler.start()
+
+    dashboard = Dashboard(profiler)
+
+    transport = MemoryTransport() if arguments.simulate else None
+    if arguments.workers > 1:
+        client = ShardedMQTT(
+            dashboard.add_alert,
+            dashboard.update_telemetry,
+            workers=arguments.workers,
+            transport=transport,
+            legacy_topics=arguments.legacy_topics,
+        )
+    else:
+        detector = FallDetector()
+        ingest = AsyncMQTT if arguments.asyncio else MQTT
+        client = ingest(
+            detector,
+            dashboard.add_alert,
+            dashboard.update_telemetry,
+            transport=transport,
+            legacy_topics=arguments.legacy_topics,
+        )
     client.begin()
 
+    if arguments.simulate:
+        devices = simulator.MQTT(MemoryTransport())
+        devices.begin()
+        generator = simulator.LoadGenerator(devices, arguments.simulate)
+        threading.Thread(
+            target=generator.run, name="simulator", daemon=True
+        ).start()
+
     dashboard.show()
@@ -1,27 +1,574 @@
 import os
+import queue
 import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from math import asin, cos, degrees, floor, pi, radians, sin, sqrt
+from urllib.request import pathname2url
 
-from datatypes import EmergencyContact, Patient
+from datatypes import EmergencyContact, Patient, PatientProfile
+from metrics import METRICS
 
 DATABASE_PATH = "./clients.sqlite"
 
+TELEMETRY_FIELDS = ("heartrate", "latitude", "longitude")
+PROFILE_FIELDS = ("firstname", "lastname", "address", "postcode")
+
+PATIENT_CACHE_SIZE = 1024
+
+# Patient positions are indexed in a grid of GRID_CELL degree squares
+GRID_CELL = 0.01
+EARTH_RADIUS = 6371.0088  # km
+
+# Every telemetry value is also appended to a history, kept as one table of
+# (patient_id, kind, timestamp, value) rows per HISTORY_BUCKET of epoch
+# milliseconds so that expiring a day is a DROP TABLE rather than a DELETE.
+# Acceleration is only summarised there, as a peak magnitude.
+HISTORY_FIELDS = TELEMETRY_FIELDS + ("acceleration",)
+HISTORY_BUCKET = 24 * 60 * 60 * 1000
+HISTORY_RETENTION = 30  # buckets
+
+# Connection settings applied by DatabaseConnection.configure. In WAL mode
+# readers do not block the telemetry writer, and synchronous=NORMAL only
+# syncs at checkpoints rather than on every commit.
+JOURNAL_MODE = "WAL"
+SYNCHRONOUS = "NORMAL"
+CACHE_SIZE = 16 * 1024  # KiB
+MMAP_SIZE = 64 * 1024 * 1024
+
+# Prepared statements kept per connection. IN-lists are padded to a power
+# of two so the patient queries only ever need a handful of them.
+CACHED_STATEMENTS = 256
+
+# Read-only connections a ConnectionPool opens at most
+READER_POOL_SIZE = 4
+
+# Schema changes since the tables were first created, in order. The number
+# applied is kept in PRAGMA user_version.
+MIGRATIONS = [
+    # Covering indexes for the per-patient allergy and contact lookups
+    [
+        """CREATE INDEX IF NOT EXISTS allergies_patient
+           ON allergies(patient_id, name)""",
+        """CREATE INDEX IF NOT EXISTS emergency_contacts_patient
+           ON emergency_contacts(
+               patient_id, firstname, lastname, relationship, phonenumber
+           )""",
+    ],
+    # Numeric coordinates. Column types can't be altered in place, so the
+    # table is copied, keeping its AUTOINCREMENT counter, and text that is
+    # not a number becomes NULL.
+    [
+        """CREATE TABLE patients_numeric(
+            id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+            firstname TEXT NOT NULL,
+            lastname TEXT NOT NULL,
+            address TEXT NOT NULL,
+            postcode TEXT NOT NULL,
+            heartrate INTEGER,
+            longitude REAL,
+            latitude REAL
+        )""",
+        """INSERT INTO patients_numeric
+           SELECT id, firstname, lastname, address, postcode, heartrate,
+               CASE WHEN longitude GLOB '*[0-9]*'
+                   THEN CAST(longitude AS REAL) END,
+               CASE WHEN latitude GLOB '*[0-9]*'
+                   THEN CAST(latitude AS REAL) END
+           FROM patients""",
+        """DELETE FROM sqlite_sequence
+           WHERE name = 'patients_numeric'""",
+        """UPDATE sqlite_sequence
+           SET name = 'patients_numeric'
+           WHERE name = 'patients'""",
+        "DROP TABLE patients",
+        "ALTER TABLE patients_numeric RENAME TO patients",
+    ],
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+# LRU cache of static patient records, with committed telemetry overlaid
+class PatientCache:
+    def __init__(self, size: int = PATIENT_CACHE_SIZE) -> None:
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+
+        # Patient id -> (shared PatientProfile, latest telemetry)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        # Bumped by every change to a patient, cached or not, so a row read
+        # before a change can't be put in after it. Clearing everything
+        # bumps the generation instead.
+        self._versions = {}
+        self._generation = 0
+
+    def get(self, patient_id: int) -> Patient:
+        with self._lock:
+            entry = self._entries.get(patient_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(patient_id)
+            self.hits += 1
+            profile, telemetry = entry
+            telemetry = dict(telemetry)
+
+        return Patient(profile, **telemetry)
+
+    # Taken before loading a patient, and given back to put
+    def version(self, patient_id: int) -> tuple:
+        with self._lock:
+            return self._generation, self._versions.get(patient_id, 0)
+
+    # A patient loaded under an older version is stale and isn't kept
+    def put(self, patient: Patient, version: tuple = None) -> None:
+        telemetry = {
+            field: getattr(patient, field) for field in TELEMETRY_FIELDS
+        }
+        with self._lock:
+            if version is not None and version != (
+                self._generation,
+                self._versions.get(patient.id, 0),
+            ):
+                return
+            self._entries[patient.id] = (patient.profile, telemetry)
+            self._entries.move_to_end(patient.id)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    # Called by the telemetry writer once a value has been committed
+    def set_telemetry(self, patient_id: int, field: str, value) -> None:
+        with self._lock:
+            self._versions[patient_id] = self._versions.get(patient_id, 0) + 1
+            entry = self._entries.get(patient_id)
+            if entry is not None:
+                entry[1][field] = value
+
+    # Drop one patient, or every patient, after their record is edited
+    def invalidate(self, patient_id: int = None) -> None:
+        with self._lock:
+            if patient_id is None:
+                self._entries.clear()
+                self._versions.clear()
+                self._generation += 1
+            else:
+                self._entries.pop(patient_id, None)
+                self._versions[patient_id] = (
+                    self._versions.get(patient_id, 0) + 1
+                )
+
+
+PATIENT_CACHE = PatientCache()
+
+
+# Great-circle distance in km
+def distance(
+    latitude: float, longitude: float, to_latitude: float, to_longitude: float
+) -> float:
+    a = (
+        sin(radians(to_latitude - latitude) / 2) ** 2
+        + cos(radians(latitude))
+        * cos(radians(to_latitude))
+        * sin(radians(to_longitude - longitude) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS * asin(min(1.0, sqrt(a)))
+
+
+# In-memory grid of patient positions, kept current by the telemetry writer.
+# A radius query only visits the cells under its bounding box, so it costs
+# the area searched and the patients found rather than a scan of the table.
+# Patients can be given a geofence, exit_callback(patient_id, distance) is
+# called when a committed position takes them outside it.
+class SpatialIndex:
+    def __init__(self, cell: float = GRID_CELL, exit_callback=None) -> None:
+        self.cell = cell
+        self.exit_callback = exit_callback
+        self.loaded = False
+
+        # Patient id -> [latitude, longitude, cell or None]
+        self._positions = {}
+        # Cell -> patient ids
+        self._cells = {}
+        # Patient id -> [latitude, longitude, radius, inside]
+        self._geofences = {}
+        self._lock = threading.Lock()
+
+    # Fill the index from the patients table
+    def load(self, database) -> None:
+        with self._lock:
+            try:
+                database.c.execute(
+                    """SELECT id, latitude, longitude
+                       FROM patients
+                       WHERE latitude IS NOT NULL AND longitude IS NOT NULL"""
+                )
+                records = database.c.fetchall()
+            finally:
+                database.db.commit()
+
+            self._positions.clear()
+            self._cells.clear()
+            for patient_id, latitude, longitude in records:
+                self._positions[patient_id] = [latitude, longitude, None]
+                self._place(patient_id)
+            self.loaded = True
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._positions.clear()
+            self._cells.clear()
+            self.loaded = False
+
+    # Apply a committed batch of (patient_id, field) -> value telemetry
+    def update(self, batch: dict) -> None:
+        exits = []
+        with self._lock:
+            moved = set()
+            for (patient_id, field), value in batch.items():
+                if field != "latitude" and field != "longitude":
+                    continue
+                position = self._positions.get(patient_id)
+                if position is None:
+                    position = [None, None, None]
+                    self._positions[patient_id] = position
+                try:
+                    position[field == "longitude"] = float(value)
+                except (TypeError, ValueError):
+                    position[field == "longitude"] = None
+                moved.add(patient_id)
+
+            for patient_id in moved:
+                kilometres = self._place(patient_id)
+                if kilometres is not None:
+                    exits.append((patient_id, kilometres))
+
+        # Called outside the lock, on the thread applying the batch
+        if self.exit_callback is not None:
+            for patient_id, kilometres in exits:
+                self.exit_callback(patient_id, kilometres)
+
+    # Move a patient to the cell of their position, returning their
+    # distance from the centre of their geofence if it has taken them out
+    def _place(self, patient_id: int) -> float:
+        position = self._positions[patient_id]
+        latitude, longitude, cell = position
+        valid = (
+            latitude is not None
+            and longitude is not None
+            and -90 <= latitude <= 90
+            and -180 <= longitude <= 180
+        )
+        new_cell = (
+            (floor(latitude / self.cell), floor(longitude / self.cell))
+            if valid
+            else None
+        )
+        if new_cell != cell:
+            if cell is not None:
+                members = self._cells[cell]
+                members.discard(patient_id)
+                if not members:
+                    del self._cells[cell]
+            if new_cell is not None:
+                self._cells.setdefault(new_cell, set()).add(patient_id)
+            position[2] = new_cell
+
+        geofence = self._geofences.get(patient_id)
+        if geofence is None or not valid:
+            return None
+        kilometres = distance(geofence[0], geofence[1], latitude, longitude)
+        inside = kilometres <= geofence[2]
+        left = geofence[3] and not inside
+        geofence[3] = inside
+        return kilometres if left else None
+
+    # (distance, patient_id) for every patient within radius km of a point,
+    # nearest first
+    def within(self, latitude: float, longitude: float, radius: float) -> list:
+        span = degrees(radius / EARTH_RADIUS)
+        # Degrees of longitude shrink towards the poles
+        narrowest = cos(radians(min(abs(latitude) + span, 90.0)))
+        longitude_span = span / narrowest if narrowest > 1e-9 else 360.0
+
+        found = []
+        with self._lock:
+            rows = range(
+                floor((latitude - span) / self.cell),
+                floor((latitude + span) / self.cell) + 1,
+            )
+            columns = range(
+                floor((longitude - longitude_span) / self.cell),
+                floor((longitude + longitude_span) / self.cell) + 1,
+            )
+            # Near the antimeridian, or when the box covers more cells than
+            # are occupied, every occupied cell is checked instead
+            if (
+                longitude - longitude_span < -180
+                or longitude + longitude_span > 180
+                or len(rows) * len(columns) > len(self._cells)
+            ):
+                cells = self._cells.values()
+            else:
+                cells = [
+                    self._cells[(row, column)]
+                    for row in rows
+                    for column in columns
+                    if (row, column) in self._cells
+                ]
+
+            for members in cells:
+                for patient_id in members:
+                    to_latitude, to_longitude, _ = self._positions[patient_id]
+                    kilometres = distance(
+                        latitude, longitude, to_latitude, to_longitude
+                    )
+                    if kilometres <= radius:
+                        found.append((kilometres, patient_id))
+
+        found.sort()
+        return found
+
+    # The count patients nearest a point, searching out to limit km
+    def nearest(
+        self,
+        latitude: float,
+        longitude: float,
+        count: int = 1,
+        limit: float = None,
+    ) -> list:
+        # Nowhere is further away than half the circumference
+        limit = pi * EARTH_RADIUS if limit is None else limit
+        # Start at about one cell and double until enough are found
+        radius = min(limit, radians(self.cell) * EARTH_RADIUS)
+        while True:
+            found = self.within(latitude, longitude, radius)
+            if len(found) >= count or radius >= limit:
+                return found[:count]
+            radius = min(limit, radius * 2)
+
+    # Fence a patient to radius km of a point. A patient already outside
+    # it is not reported until they have come back in and left again.
+    def set_geofence(
+        self, patient_id: int, latitude: float, longitude: float, radius: float
+    ) -> None:
+        with self._lock:
+            self._geofences[patient_id] = [latitude, longitude, radius, True]
+            if patient_id in self._positions:
+                self._place(patient_id)
+
+    def clear_geofence(self, patient_id: int) -> None:
+        with self._lock:
+            self._geofences.pop(patient_id, None)
+
+    # Patients last seen outside their geofence
+    def outside_geofences(self) -> list:
+        with self._lock:
+            return [
+                patient_id
+                for patient_id, geofence in self._geofences.items()
+                if not geofence[3]
+            ]
+
+
+LOCATIONS = SpatialIndex()
+
+
+# Time-partitioned, append-only telemetry history
+class TelemetryHistory:
+
+    PREFIX = "telemetry_history_"
+
+    def __init__(
+        self, bucket: int = HISTORY_BUCKET, retention: int = HISTORY_RETENTION
+    ) -> None:
+        self.bucket = bucket
+        self.retention = retention
+
+    def table(self, bucket: int) -> str:
+        return f"{TelemetryHistory.PREFIX}{bucket}"
+
+    # Buckets that have a table, oldest first
+    def buckets(self, database) -> list:
+        database.c.execute(
+            """SELECT name
+               FROM sqlite_master
+               WHERE type = 'table' AND name LIKE ?""",
+            [f"{TelemetryHistory.PREFIX}%"],
+        )
+        return sorted(
+            int(name[len(TelemetryHistory.PREFIX) :])
+            for name, in database.c.fetchall()
+        )
+
+    # Insert rows of (patient_id, field, value, timestamp), the caller owns
+    # the transaction
+    def append(self, database, rows) -> int:
+        buckets = {}
+        for patient_id, field, value, timestamp in rows:
+            try:
+                value = float(value)
+            except (TypeError, ValueError):
+                continue
+            buckets.setdefault(timestamp // self.bucket, []).append(
+                (patient_id, HISTORY_FIELDS.index(field), timestamp, value)
+            )
+
+        written = 0
+        for bucket, parameters in buckets.items():
+            if bucket not in database.history_buckets:
+                self._create(database, bucket)
+            database.c.executemany(
+                f"""INSERT OR REPLACE INTO {self.table(bucket)}
+                    (patient_id, kind, timestamp, value)
+                    VALUES (?, ?, ?, ?)""",
+                parameters,
+            )
+            written += len(parameters)
+        return written
+
+    # A new bucket is the only time old ones can have expired
+    def _create(self, database, bucket: int) -> None:
+        database.c.execute(
+            f"""CREATE TABLE IF NOT EXISTS {self.table(bucket)}(
+                patient_id INTEGER NOT NULL,
+                kind INTEGER NOT NULL,
+                timestamp INTEGER NOT NULL,
+                value REAL NOT NULL,
+                PRIMARY KEY (patient_id, kind, timestamp)
+            ) WITHOUT ROWID"""
+        )
+        database.history_buckets.add(bucket)
+        self.expire(database, bucket - self.retention)
+
+    # Drop every bucket up to and including the given one
+    def expire(self, database, bucket: int) -> None:
+        for existing in self.buckets(database):
+            if existing > bucket:
+                break
+            database.c.execute(f"DROP TABLE {self.table(existing)}")
+            database.history_buckets.discard(existing)
+
+    # (timestamp, value) rows for one patient and field between two epoch
+    # millisecond times, oldest first
+    def range(
+        self, database, patient_id: int, field: str, start: int, end: int
+    ) -> list:
+        kind = HISTORY_FIELDS.index(field)
+        rows = []
+        for bucket in self.buckets(database):
+            if start // self.bucket <= bucket <= end // self.bucket:
+                database.c.execute(
+                    f"""SELECT timestamp, value
+                        FROM {self.table(bucket)}
+                        WHERE patient_id = ? AND kind = ?
+                        AND timestamp BETWEEN ? AND ?
+                        ORDER BY timestamp""",
+                    [patient_id, kind, start, end],
+                )
+                rows.extend(database.c.fetchall())
+        return rows
+
+
+HISTORY = TelemetryHistory()
+
 
 class DatabaseConnection:
 
-    PATH = "./clients.sqlite"
+    # Longer id lists are staged in a temporary table instead of an IN-list
+    IN_LIST_LIMIT = 500
 
-    def __init__(self) -> None:
-        if os.path.isfile(DATABASE_PATH):
-            self.db = sqlite3.connect(DatabaseConnection.PATH)
+    def __init__(
+        self,
+        path: str = DATABASE_PATH,
+        journal_mode: str = JOURNAL_MODE,
+        synchronous: str = SYNCHRONOUS,
+        read_only: bool = False,
+        check_same_thread: bool = True,
+    ) -> None:
+        self.path = path
+        self.read_only = read_only
+        # History buckets known to have a table on this connection
+        self.history_buckets = set()
+        if os.path.isfile(path):
+            if read_only:
+                uri = f"file:{pathname2url(os.path.abspath(path))}?mode=ro"
+            self.db = sqlite3.connect(
+                uri if read_only else path,
+                uri=read_only,
+                check_same_thread=check_same_thread,
+                cached_statements=CACHED_STATEMENTS,
+            )
             self.c = self.db.cursor()
+            self.configure(journal_mode, synchronous)
+            if not read_only:
+                self.migrate()
         else:
             print("ERROR: Patient database file not found.")
             print("!! Please open the project from its root directory. !!")
 
+    def configure(
+        self, journal_mode: str = JOURNAL_MODE, synchronous: str = SYNCHRONOUS
+    ) -> None:
+        # The journal mode is stored in the file, so only a writer sets it
+        if not self.read_only:
+            self.c.execute(f"PRAGMA journal_mode = {journal_mode}")
+        self.c.execute(f"PRAGMA synchronous = {synchronous}")
+        self.c.execute(f"PRAGMA cache_size = {-CACHE_SIZE}")
+        self.c.execute(f"PRAGMA mmap_size = {MMAP_SIZE}")
+
+    # The cursor is closed first, otherwise a statement left open by
+    # executemany keeps the file (and its write-ahead log) in use
+    def close(self) -> None:
+        self.c.close()
+        self.db.close()
+
+    # Apply any migrations an existing database is missing, safe to repeat
+    def migrate(self) -> None:
+        if self._schema_version() >= SCHEMA_VERSION:
+            return
+
+        self.c.execute(
+            """SELECT 1
+               FROM sqlite_master
+               WHERE type = 'table' AND name = 'patients'"""
+        )
+        if self.c.fetchone() is None:
+            # Empty file, rebuild creates the current schema
+            return
+
+        # Take the write lock first so only one connection migrates
+        self.c.execute("BEGIN IMMEDIATE")
+        try:
+            self._apply_migrations(self._schema_version())
+        except sqlite3.Error:
+            self.db.rollback()
+            raise
+        self.db.commit()
+
+    def _schema_version(self) -> int:
+        self.c.execute("PRAGMA user_version")
+        return self.c.fetchone()[0]
+
+    def _apply_migrations(self, version: int) -> None:
+        for statements in MIGRATIONS[version:]:
+            for statement in statements:
+                self.c.execute(statement)
+        self.c.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
     # Reconstuct the database
     def rebuild(self) -> None:
-        with open(DATABASE_PATH, "w") as file:
-            file.write("")
+        # Tables are dropped rather than the file truncated, which would
+        # corrupt a database with a write-ahead log
+        for table in ("allergies", "emergency_contacts", "patients"):
+            self.c.execute(f"DROP TABLE IF EXISTS {table}")
+        HISTORY.expire(self, float("inf"))
+        PATIENT_CACHE.invalidate()
+        LOCATIONS.invalidate()
 
         self.c.execute(
             """CREATE TABLE patients(
@@ -57,48 +604,495 @@ class DatabaseConnection:
             )
             """
         )
+        self._apply_migrations(0)
+        self.db.commit()
 
-    # Get a list of patient ids from the database
-    def get_patient_ids(self) -> list:
+    # Get a list of patient ids from the database, optionally only the ones
+    # created after a given id
+    def get_patient_ids(self, after: int = 0) -> list:
         self.c.execute(
             """SELECT id
-               FROM patients"""
+               FROM patients
+               WHERE id > ?
+               ORDER BY id""",
+            [after],
         )
         return [record[0] for record in self.c.fetchall()]
 
-    # Fetch a patient record from the database
+    # Telemetry history for a patient between two epoch millisecond times,
+    # as a list of (timestamp, value)
+    def get_history(
+        self, patient_id: int, field: str, start: int, end: int
+    ) -> list:
+        return HISTORY.range(self, patient_id, field, start, end)
+
+    # Reported positions between two epoch millisecond times, as a list of
+    # (timestamp, latitude, longitude). Latitude and longitude arrive as
+    # separate messages, latitude first, so each longitude is paired with
+    # the latitude reported before it.
+    def get_location_trail(
+        self, patient_id: int, start: int, end: int
+    ) -> list:
+        latitudes = HISTORY.range(self, patient_id, "latitude", start, end)
+        longitudes = HISTORY.range(self, patient_id, "longitude", start, end)
+
+        trail = []
+        index = 0
+        latitude = None
+        for timestamp, longitude in longitudes:
+            while index < len(latitudes) and latitudes[index][0] <= timestamp:
+                latitude = latitudes[index][1]
+                index += 1
+            if latitude is not None:
+                trail.append((timestamp, latitude, longitude))
+        return trail
+
+    # (distance km, patient_id) for the patients within radius km of a
+    # point, nearest first
+    def get_patients_within(
+        self, latitude: float, longitude: float, radius: float
+    ) -> list:
+        if not LOCATIONS.loaded:
+            LOCATIONS.load(self)
+        return LOCATIONS.within(latitude, longitude, radius)
+
+    # (distance km, patient_id) for the count patients nearest a point,
+    # optionally no further than limit km
+    def get_nearest_patients(
+        self,
+        latitude: float,
+        longitude: float,
+        count: int = 1,
+        limit: float = None,
+    ) -> list:
+        if not LOCATIONS.loaded:
+            LOCATIONS.load(self)
+        return LOCATIONS.nearest(latitude, longitude, count, limit)
+
+    # Raise a geofence alert when a patient moves further than radius km
+    # from a point. Fences are kept in memory by the process receiving
+    # telemetry, and last until cleared or restart.
+    def set_geofence(
+        self, patient_id: int, latitude: float, longitude: float, radius: float
+    ) -> None:
+        if not LOCATIONS.loaded:
+            LOCATIONS.load(self)
+        LOCATIONS.set_geofence(patient_id, latitude, longitude, radius)
+
+    def clear_geofence(self, patient_id: int) -> None:
+        LOCATIONS.clear_geofence(patient_id)
+
+    # Ids of the fenced patients whose last position was outside the fence
+    def get_patients_outside_geofences(self) -> list:
+        return LOCATIONS.outside_geofences()
+
+    # Fetch a patient record, from the cache where possible
     def get_patient(self, patient_id: int) -> Patient:
-        self.c.execute(
-            """SELECT id, firstname, lastname, address, postcode, heartrate, longitude, latitude
-            FROM patients
-            WHERE id = ?""",
-            [patient_id],
-        )
-        patient_record = self.c.fetchone()
-        if patient_record is None:
-            return None
+        patient = PATIENT_CACHE.get(patient_id)
+        if patient is None:
+            version = PATIENT_CACHE.version(patient_id)
+            patient = self._load_patient(patient_id)
+            if patient is not None:
+                PATIENT_CACHE.put(patient, version)
+        return patient
 
-        self.c.execute(
-            """SELECT name
-               FROM allergies
-               WHERE patient_id = ?""",
-            [patient_id],
-        )
-        allergies = [record[0] for record in self.c.fetchall()]
+    # Edit the static fields of a patient record
+    def update_patient(self, patient_id: int, **fields) -> None:
+        for field in fields:
+            if field not in PROFILE_FIELDS:
+                raise ValueError(f"Unknown patient field: {field}")
 
-        self.c.execute(
-            """SELECT firstname, lastname, relationship, phonenumber
-               FROM emergency_contacts
-               WHERE patient_id = ?""",
-            [patient_id],
+        assignments = ", ".join(f"{field} = ?" for field in fields)
+        with self.db:
+            self.c.execute(
+                f"""UPDATE patients
+                    SET {assignments}
+                    WHERE id = ?""",
+                [*fields.values(), patient_id],
+            )
+        self.invalidate_patient(patient_id)
+
+    # Must be called after any other edit to a patient, their allergies or
+    # their emergency contacts
+    def invalidate_patient(self, patient_id: int) -> None:
+        PATIENT_CACHE.invalidate(patient_id)
+
+    # Fetch many patient records, loading any not cached in three queries
+    def get_patients(self, patient_ids) -> dict:
+        patient_ids = list(dict.fromkeys(patient_ids))
+        patients = {}
+        missing = []
+        for patient_id in patient_ids:
+            patient = PATIENT_CACHE.get(patient_id)
+            if patient is None:
+                missing.append(patient_id)
+            else:
+                patients[patient_id] = patient
+
+        if missing:
+            versions = {
+                patient_id: PATIENT_CACHE.version(patient_id)
+                for patient_id in missing
+            }
+            for patient in self._load_patients(missing).values():
+                PATIENT_CACHE.put(patient, versions[patient.id])
+                patients[patient.id] = patient
+
+        return {
+            patient_id: patients[patient_id]
+            for patient_id in patient_ids
+            if patient_id in patients
+        }
+
+    # Fetch a patient record from the database
+    def _load_patient(self, patient_id: int) -> Patient:
+        return self._load_patients([patient_id]).get(patient_id)
+
+    # Fetch patient records from the database, grouping rows in Python
+    def _load_patients(self, patient_ids: list) -> dict:
+        try:
+            if len(patient_ids) <= DatabaseConnection.IN_LIST_LIMIT:
+                # Repeating the last id keeps the statement text, and so
+                # the cached statement, the same for similar list lengths
+                size = 1 << (len(patient_ids) - 1).bit_length()
+                selection = f"({', '.join('?' * size)})"
+                parameters = patient_ids + patient_ids[-1:] * (
+                    size - len(patient_ids)
+                )
+            else:
+                self.c.execute(
+                    """CREATE TEMP TABLE IF NOT EXISTS patient_selection(
+                        id INTEGER PRIMARY KEY
+                    )
+                    """
+                )
+                self.c.execute("DELETE FROM temp.patient_selection")
+                self.c.executemany(
+                    """INSERT OR IGNORE INTO temp.patient_selection (id)
+                       VALUES (?)""",
+                    [(patient_id,) for patient_id in patient_ids],
+                )
+                selection = "(SELECT id FROM temp.patient_selection)"
+                parameters = []
+
+            self.c.execute(
+                f"""SELECT id, firstname, lastname, address, postcode, heartrate, longitude, latitude
+                FROM patients
+                WHERE id IN {selection}""",
+                parameters,
+            )
+            patient_records = self.c.fetchall()
+
+            allergies = {}
+            self.c.execute(
+                f"""SELECT patient_id, name
+                   FROM allergies
+                   WHERE patient_id IN {selection}""",
+                parameters,
+            )
+            for patient_id, name in self.c.fetchall():
+                allergies.setdefault(patient_id, []).append(name)
+
+            emergency_contacts = {}
+            self.c.execute(
+                f"""SELECT patient_id, firstname, lastname, relationship, phonenumber
+                   FROM emergency_contacts
+                   WHERE patient_id IN {selection}""",
+                parameters,
+            )
+            for patient_id, *record in self.c.fetchall():
+                emergency_contacts.setdefault(patient_id, []).append(
+                    EmergencyContact(*record)
+                )
+        finally:
+            # Never hold a transaction open on a reading connection
+            self.db.commit()
+
+        return {
+            record[0]: Patient(
+                PatientProfile(
+                    *record[0:5],
+                    tuple(allergies.get(record[0], ())),
+                    tuple(emergency_contacts.get(record[0], ())),
+                ),
+                *record[5:],
+            )
+            for record in patient_records
+        }
+
+
+# Hands out pooled connections to one database: up to size read-only
+# connections shared by reading threads, and a single writer connection.
+# In WAL mode readers never wait for the writer to commit.
+class ConnectionPool:
+    def __init__(
+        self, path: str = DATABASE_PATH, size: int = READER_POOL_SIZE
+    ) -> None:
+        self.path = path
+        self.size = size
+        self.opened = 0
+        self.waits = 0
+
+        self._readers = queue.LifoQueue()
+        self._writer = None
+        self._lock = threading.Lock()
+        self._writer_lock = threading.RLock()
+
+        # Connection already checked out by the current thread, if any
+        self._local = threading.local()
+
+    # Nested checkouts on one thread get the connection it already holds
+    @contextmanager
+    def reader(self) -> DatabaseConnection:
+        held = getattr(self._local, "reader", None)
+        if held is not None:
+            yield held
+            return
+
+        database = self._take_reader()
+        self._local.reader = database
+        try:
+            yield database
+        finally:
+            self._local.reader = None
+            # Never return a connection holding a read snapshot open
+            if database.db.in_transaction:
+                database.db.rollback()
+            self._readers.put(database)
+
+    @contextmanager
+    def writer(self) -> DatabaseConnection:
+        with self._writer_lock:
+            if self._writer is None:
+                self._writer = self._connect(read_only=False)
+            try:
+                yield self._writer
+            except BaseException:
+                if self._writer.db.in_transaction:
+                    self._writer.db.rollback()
+                raise
+
+    def close(self) -> None:
+        with self._writer_lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+        with self._lock:
+            while self.opened:
+                self._readers.get().close()
+                self.opened -= 1
+
+    def _take_reader(self) -> DatabaseConnection:
+        try:
+            return self._readers.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            if self.opened < self.size:
+                # The writer migrates the schema before any reader opens
+                if self._writer is None:
+                    with self.writer():
+                        pass
+                self.opened += 1
+                return self._connect(read_only=True)
+
+        self.waits += 1
+        return self._readers.get()
+
+    # Pooled connections move between threads, one checkout at a time
+    def _connect(self, read_only: bool) -> DatabaseConnection:
+        return DatabaseConnection(
+            self.path, read_only=read_only, check_same_thread=False
         )
-        emergency_contacts = [
-            EmergencyContact(*record) for record in self.c.fetchall()
-        ]
-
-        return Patient(
-            *patient_record[0:5],
-            allergies,
-            emergency_contacts,
-            *patient_record[5:]
+
+
+# Shared by everything using the default database
+POOL = ConnectionPool()
+
+
+# Bring this process's patient cache and spatial index up to date with a
+# committed batch, {(patient_id, field): value}
+def apply_telemetry(batch: dict) -> None:
+    for (patient_id, field), value in batch.items():
+        PATIENT_CACHE.set_telemetry(patient_id, field, value)
+    LOCATIONS.update(batch)
+
+
+# Write-behind stage for patient telemetry, drained in bounded batches
+class TelemetryWriter:
+
+    BATCH_SIZE = 512
+    FLUSH_INTERVAL = 0.25
+    HIGH_WATER_MARK = 10000
+    REPORT_INTERVAL = 60
+
+    STATEMENTS = {
+        field: f"""UPDATE patients
+                   SET {field} = ?
+                   WHERE id = ?"""
+        for field in TELEMETRY_FIELDS
+    }
+
+    def __init__(
+        self,
+        batch_size: int = BATCH_SIZE,
+        flush_interval: float = FLUSH_INTERVAL,
+        high_water_mark: int = HIGH_WATER_MARK,
+        block: bool = False,
+        commit_callback=None,
+        batch_callback=None,
+    ) -> None:
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.block = block
+        self.commit_callback = commit_callback
+
+        # Given each committed batch, for a process keeping its own copies
+        self.batch_callback = batch_callback
+        self.updates = queue.Queue(maxsize=high_water_mark)
+
+        # Statistics
+        self.received = 0
+        self.dropped = 0
+        self.failed = 0
+        self.flushes = 0
+        self.rows_written = 0
+        self.history_written = 0
+        self.last_flush_latency = 0.0
+        self.total_flush_latency = 0.0
+        self._last_report = time.monotonic()
+        self._commit_seconds = None
+        if METRICS.enabled:
+            self._commit_seconds = METRICS.histogram(
+                "telemetry_commit_seconds",
+                "Time to write and commit one telemetry batch",
+            )
+
+    # Queue a telemetry value, returns False if it was dropped. Values are
+    # stamped with the time they arrived, in epoch milliseconds, for the
+    # history.
+    def put(
+        self, patient_id: int, field: str, value, timestamp: int = None
+    ) -> bool:
+        if field not in HISTORY_FIELDS:
+            raise ValueError(f"Unknown telemetry field: {field}")
+        if timestamp is None:
+            timestamp = time.time_ns() // 1000000
+
+        try:
+            # Block (backpressure) or drop once the high-water mark is hit
+            self.updates.put(
+                (patient_id, field, value, timestamp), block=self.block
+            )
+        except queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    # Drain the queue forever, committing one transaction per batch
+    def run(self, pool: ConnectionPool) -> None:
+        while True:
+            batch, history = self._collect()
+            with pool.writer() as database:
+                self.flush(database, batch, history)
+
+            if time.monotonic() - self._last_report > self.REPORT_INTERVAL:
+                self.report()
+
+    # Wait for an update, then gather more until the batch is full or stale
+    def _collect(self) -> tuple:
+        batch = {}
+        history = []
+        self.fold(batch, history, self.updates.get())
+        received = 1
+
+        deadline = time.monotonic() + self.flush_interval
+        while received < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                update = self.updates.get(timeout=timeout)
+            except queue.Empty:
+                break
+            self.fold(batch, history, update)
+            received += 1
+
+        self.received += received
+        return batch, history
+
+    # Add a queued update to the history rows, and to the batch of current
+    # values if it is one the patients table keeps
+    @staticmethod
+    def fold(batch: dict, history: list, update: tuple) -> None:
+        history.append(update)
+        patient_id, field, value, _ = update
+        if field in TELEMETRY_FIELDS:
+            # Only the newest value per (patient, field) is kept
+            batch[(patient_id, field)] = value
+
+    # Write a coalesced batch with executemany, and append its history, inside
+    # a single transaction
+    def flush(self, database, batch: dict, history: list = ()) -> None:
+        rows = {}
+        for (patient_id, field), value in batch.items():
+            rows.setdefault(field, []).append((value, patient_id))
+
+        start = time.perf_counter()
+        try:
+            with database.db:
+                for field, parameters in rows.items():
+                    database.c.executemany(
+                        TelemetryWriter.STATEMENTS[field], parameters
+                    )
+                history_written = HISTORY.append(database, history)
+        # Anything raised is the batch's fault, such as a value too large
+        # for SQLite, and must not end the writer
+        except Exception as error:
+            print(f"ERROR: Telemetry batch of {len(batch)} failed: {error}")
+            # Every update folded into the batch is lost with it
+            self.failed += max(len(history), len(batch))
+            # Tables created in the rolled back transaction are gone again
+            database.history_buckets.clear()
+            return
+
+        self.last_flush_latency = time.perf_counter() - start
+        if self._commit_seconds is not None:
+            self._commit_seconds.observe(self.last_flush_latency)
+        apply_telemetry(batch)
+        if self.batch_callback is not None and batch:
+            self.batch_callback(batch)
+        if self.commit_callback is not None and batch:
+            self.commit_callback({patient_id for patient_id, _ in batch})
+
+        self.total_flush_latency += self.last_flush_latency
+        self.flushes += 1
+        self.rows_written += len(batch)
+        self.history_written += history_written
+
+    def statistics(self) -> dict:
+        flushes = max(self.flushes, 1)
+        return {
+            "received": self.received,
+            "dropped": self.dropped,
+            "failed": self.failed,
+            "queued": self.updates.qsize(),
+            "flushes": self.flushes,
+            "rows_written": self.rows_written,
+            "rows_per_commit": self.rows_written / flushes,
+            "history_written": self.history_written,
+            "last_flush_latency": self.last_flush_latency,
+            "mean_flush_latency": self.total_flush_latency / flushes,
+        }
+
+    def report(self) -> None:
+        stats = self.statistics()
+        print(
+            f"Telemetry: {stats['flushes']} commits, "
+            f"{stats['rows_per_commit']:.1f} rows/commit, "
+            f"{stats['mean_flush_latency'] * 1000:.2f} ms/flush, "
+            f"{stats['dropped']} dropped, {stats['failed']} failed, "
+            f"{stats['queued']} queued"
         )
+        self._last_report = time.monotonic()
@@ -1,8 +1,18 @@
 import datetime
+from typing import NamedTuple
 
 
 # Objective Emergency Contact Record
 class EmergencyContact:
+
+    __slots__ = (
+        "firstname",
+        "lastname",
+        "relationship",
+        "phonenumber",
+        "_string",
+    )
+
     def __init__(
         self,
         firstname: str,
@@ -14,49 +24,127 @@ class EmergencyContact:
         self.lastname = lastname
         self.relationship = relationship
         self.phonenumber = phonenumber
+        self._string = None
 
     def __str__(self) -> str:
-        string = f"[{self.relationship}] - "
-        string += f"{self.firstname} {self.lastname} - "
-        return string + f"{self.phonenumber}"
+        if self._string is None:
+            string = f"[{self.relationship}] - "
+            string += f"{self.firstname} {self.lastname} - "
+            self._string = string + f"{self.phonenumber}"
+        return self._string
+
 
+# The parts of a patient record that only change when it is edited. One
+# profile is shared by every Patient, and so every Alert, built from the
+# same cached record.
+class PatientProfile(NamedTuple):
+    id: int
+    firstname: str
+    lastname: str
+    address: str
+    postcode: str
+    allergies: tuple = ()
+    emergency_contacts: tuple = ()
 
-# Objective Patient Record
+
+# Objective Patient Record, a shared profile and the latest telemetry
 class Patient:
+
+    __slots__ = ("profile", "heartrate", "longitude", "latitude")
+
     def __init__(
         self,
-        id: int,
-        firstname: str,
-        lastname: str,
-        address: str,
-        postcode: str,
-        allergies: list = [],
-        emergency_contacts: list = [],
+        profile: PatientProfile,
         heartrate: int = None,
-        longitude: str = None,
-        latitude: str = None,
+        longitude: float = None,
+        latitude: float = None,
     ) -> None:
-        self.id = id
-        self.firstname = firstname
-        self.lastname = lastname
-        self.address = address
-        self.postcode = postcode
-        self.allergies = allergies
-        self.emergency_contacts = emergency_contacts
+        self.profile = profile
         self.heartrate = heartrate
         self.longitude = longitude
         self.latitude = latitude
 
+    @property
+    def id(self) -> int:
+        return self.profile.id
+
+    @property
+    def firstname(self) -> str:
+        return self.profile.firstname
+
+    @property
+    def lastname(self) -> str:
+        return self.profile.lastname
+
+    @property
+    def address(self) -> str:
+        return self.profile.address
+
+    @property
+    def postcode(self) -> str:
+        return self.profile.postcode
+
+    @property
+    def allergies(self) -> tuple:
+        return self.profile.allergies
+
+    @property
+    def emergency_contacts(self) -> tuple:
+        return self.profile.emergency_contacts
+
 
 class Alert:
+
+    __slots__ = (
+        "id",
+        "patient",
+        "timestamp",
+        "location",
+        "count",
+        "last_timestamp",
+        "peak_magnitude",
+        "kind",
+        "severity",
+        "_datetime",
+        "_string",
+    )
+
     def __init__(
-        self, patient: Patient, timestamp: float, location: tuple = None
+        self,
+        patient: Patient,
+        timestamp: float,
+        location: tuple = None,
+        count: int = 1,
+        last_timestamp: float = None,
+        peak_magnitude: float = None,
+        kind: str = "fall",
+        severity: int = 1,
     ) -> None:
+        self.id = None
         self.patient = patient
         self.timestamp = timestamp
+        self.location = location
+
+        # Repeated triggers folded into this alert
+        self.count = count
+        self.last_timestamp = (
+            timestamp if last_timestamp is None else last_timestamp
+        )
+        self.peak_magnitude = peak_magnitude
+
+        # "fall" or "heartrate", severity is raised when both happen
+        # together
+        self.kind = kind
+        self.severity = severity
+
+        # Derived values, made when first asked for
+        self._datetime = None
+        self._string = None
 
     def get_datetime_object(self) -> datetime.datetime:
-        return datetime.datetime.utcfromtimestamp(self.timestamp)
+        if self._datetime is None:
+            self._datetime = datetime.datetime.utcfromtimestamp(self.timestamp)
+        return self._datetime
 
     def get_location_url(self) -> str:
         URL = "https://maps.google.co.uk/"
@@ -67,6 +155,23 @@ class Alert:
         else:
             return f"{URL}/?q=<{self.location[0]}>,<{self.location[1]}>"
 
+    # Remade only when the trigger count, the severity or the patient's
+    # profile changes
     def __str__(self) -> str:
-        time = self.get_datetime_object().strftime("%H:%M")
-        return f"[{time}] - {self.patient.firstname} {self.patient.lastname}"
+        profile = self.patient.profile
+        if (
+            self._string is None
+            or self._string[0] != self.count
+            or self._string[1] != self.severity
+            or self._string[2] is not profile
+        ):
+            time = self.get_datetime_object().strftime("%H:%M")
+            string = f"[{time}] - {profile.firstname} {profile.lastname}"
+            if self.kind != "fall":
+                string += f" - {self.kind.capitalize()}"
+            if self.count > 1:
+                string += f" (x{self.count})"
+            if self.severity > 1:
+                string = "!! " + string
+            self._string = (self.count, self.severity, profile, string)
+        return self._string[3]
@@ -0,0 +1,462 @@
+import asyncio
+import multiprocessing
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from database import ConnectionPool, apply_telemetry
+from metrics import METRICS
+from processing import MQTT, SUBTOPICS, FallDetector
+
+WORKERS = os.cpu_count() or 1
+
+
+# Runs in each worker process: detection, coalescing and telemetry writes
+# for the patients whose id hashes to this shard. Committed batches are sent
+# back whole, as the patient cache and spatial index the dashboard reads are
+# the ones in the coordinating process.
+def run_shard(messages, results, database_path: str) -> None:
+    mqtt = MQTT(
+        FallDetector(),
+        lambda *alert: results.put(("alert", alert)),
+        pool=ConnectionPool(database_path),
+    )
+    mqtt.telemetry_writer.batch_callback = lambda batch: results.put(
+        ("telemetry", batch)
+    )
+    threading.Thread(
+        target=mqtt._database_thread, name="database-writer", daemon=True
+    ).start()
+
+    handlers = {
+        subtopic: getattr(mqtt, f"_on_{subtopic}") for subtopic in SUBTOPICS
+    }
+    while True:
+        batch = messages.get()
+        if batch is None:
+            break
+        for subtopic, patient_id, payload in batch:
+            handlers[subtopic](patient_id, payload)
+
+    results.put(("statistics", (mqtt.invalid_payloads, mqtt.sequence_gaps)))
+
+
+# Receives from the broker like MQTT, but hash-partitions patients across
+# worker processes, each with its own detector state and database writer.
+# Alerts and telemetry commits come back to the callbacks on this process.
+class ShardedMQTT(MQTT):
+
+    # Messages are sent to a worker in batches of up to FORWARD_BATCH, or
+    # after FORWARD_INTERVAL seconds, to keep the cost of pickling down
+    FORWARD_BATCH = 256
+    FORWARD_INTERVAL = 0.01
+
+    def __init__(
+        self,
+        dashboard_callback,
+        telemetry_callback=None,
+        workers: int = WORKERS,
+        **kwargs,
+    ) -> None:
+        super().__init__(
+            None, dashboard_callback, telemetry_callback, **kwargs
+        )
+        self.telemetry_callback = telemetry_callback
+        self.workers = workers
+        self.forwarded = 0
+
+        # Counted from what the workers send back
+        self.alerts_raised = {}
+        self.rows_committed = 0
+
+        self._results = multiprocessing.Queue()
+        self._shards = [multiprocessing.Queue() for _ in range(workers)]
+        self._pending = [[] for _ in range(workers)]
+        self._lock = threading.Lock()
+        self._processes = []
+
+        for subtopic in SUBTOPICS:
+            self.dispatcher.register(
+                subtopic, partial(self._forward, subtopic)
+            )
+
+    # Detection and telemetry writes happen in the workers, so this process
+    # exports what passes through it rather than its own idle writer and
+    # coalescers. Worker queue depths and failures stay in the workers.
+    def _register_metrics(self) -> None:
+        METRICS.counter_function(
+            "ingest_forwarded_total",
+            "Messages forwarded to shard workers",
+            lambda: self.forwarded,
+        )
+        METRICS.counter_function(
+            "telemetry_rows_written_total",
+            "Patient rows updated by the telemetry writer",
+            lambda: self.rows_committed,
+        )
+        for kind in ("fall", "heartrate"):
+            METRICS.counter_function(
+                "alerts_raised_total",
+                "New alerts raised, by kind",
+                lambda kind=kind: self.alerts_raised.get(kind, 0),
+                kind=kind,
+            )
+        METRICS.counter_function(
+            "alerts_raised_total",
+            "New alerts raised, by kind",
+            lambda: self.geofence_coalescer.raised,
+            kind="geofence",
+        )
+        METRICS.counter_function(
+            "ingest_unknown_patient_total",
+            "Messages dropped for patients missing from the roster",
+            lambda: self.dispatcher.unknown,
+        )
+        METRICS.counter_function(
+            "ingest_unroutable_total",
+            "Messages on topics that match no patient and subtopic",
+            lambda: self.dispatcher.unroutable,
+        )
+
+    def begin(self) -> None:
+        self.start_workers()
+        self.watch_geofences()
+        self.refresh_roster()
+        self.client.connect()
+        threading.Thread(
+            target=self._roster_thread, name="roster", daemon=True
+        ).start()
+        self.client.loop_start()
+
+    def start_workers(self) -> None:
+        for shard in self._shards:
+            process = multiprocessing.Process(
+                target=run_shard,
+                args=(shard, self._results, self.pool.path),
+                daemon=True,
+            )
+            process.start()
+            self._processes.append(process)
+
+        threading.Thread(
+            target=self._results_thread, name="shard-results", daemon=True
+        ).start()
+        threading.Thread(
+            target=self._forward_thread, name="shard-forward", daemon=True
+        ).start()
+
+    # Send what is pending and wait for the workers to finish with it
+    def stop_workers(self) -> None:
+        self.flush()
+        for shard in self._shards:
+            shard.put(None)
+        for process in self._processes:
+            process.join()
+        self._processes.clear()
+
+    def _forward(self, subtopic: str, patient_id: int, payload: bytes) -> None:
+        shard = patient_id % self.workers
+        # Batches are queued under the lock so a shard sees them in order
+        with self._lock:
+            pending = self._pending[shard]
+            pending.append((subtopic, patient_id, payload))
+            self.forwarded += 1
+            if len(pending) >= self.FORWARD_BATCH:
+                self._shards[shard].put(pending)
+                self._pending[shard] = []
+
+    def flush(self) -> None:
+        with self._lock:
+            for shard, pending in enumerate(self._pending):
+                if pending:
+                    self._shards[shard].put(pending)
+                    self._pending[shard] = []
+
+    def _forward_thread(self) -> None:
+        while True:
+            time.sleep(self.FORWARD_INTERVAL)
+            self.flush()
+
+    def _results_thread(self) -> None:
+        while True:
+            kind, value = self._results.get()
+            if kind == "alert":
+                # (patient_id, first, last, count, peak, kind, severity)
+                if value[3] == 1:
+                    self.alerts_raised[value[5]] = (
+                        self.alerts_raised.get(value[5], 0) + 1
+                    )
+                self.dashboard_callback(*value)
+            elif kind == "telemetry":
+                apply_telemetry(value)
+                self.rows_committed += len(value)
+                if self.telemetry_callback is not None:
+                    self.telemetry_callback(
+                        {patient_id for patient_id, _ in value}
+                    )
+            else:
+                invalid_payloads, sequence_gaps = value
+                self.invalid_payloads += invalid_payloads
+                self.sequence_gaps += sequence_gaps
+
+
+# MQTT with parse, detect and persist stages as asyncio tasks joined by
+# bounded queues, so a slow stage holds back the ones before it. The
+# transport's network thread hands messages to the event loop in batches
+# and blocks once QUEUE_SIZE are waiting, which pushes back on the socket.
+# It is not faster than the threaded MQTT, see benchmark.py pipeline.
+class AsyncMQTT(MQTT):
+
+    QUEUE_SIZE = 10000
+
+    # Stages pass work on in lists of up to this many items
+    STAGE_BATCH = 256
+
+    def __init__(
+        self,
+        detector,
+        dashboard_callback,
+        telemetry_callback=None,
+        queue_size: int = QUEUE_SIZE,
+        **kwargs,
+    ) -> None:
+        super().__init__(
+            detector, dashboard_callback, telemetry_callback, **kwargs
+        )
+        self.queue_size = queue_size
+
+        # Messages taken off the inbox and dispatched
+        self.processed = 0
+
+        # Filled by the network thread, drained by the parse stage
+        self._inbox = deque()
+        self._accepting = threading.Event()
+        self._accepting.set()
+        self._wakeup_pending = False
+
+        self._loop = None
+        self._task = None
+
+        # Parsed messages waiting to be passed to the next stage
+        self._windows = []
+        self._updates = []
+
+        # Updates handed to the persist stage and not yet committed
+        self._pending_updates = 0
+
+        # Heartrates and coordinates go through MQTT's handlers, which
+        # call _record
+        self.dispatcher.register("acceleration", self._queue_acceleration)
+
+        if METRICS.enabled:
+            METRICS.gauge(
+                "ingest_inbox_depth",
+                "Messages waiting for the parse stage",
+                self._inbox.__len__,
+            )
+            # Replaces MQTT's, this pipeline doesn't use the writer's queue
+            METRICS.gauge(
+                "telemetry_queue_depth",
+                "Telemetry updates waiting for the database writer",
+                lambda: self._pending_updates + len(self._updates),
+            )
+
+    # Run the pipeline on its own event loop thread
+    def begin(self) -> None:
+        self.watch_geofences()
+        threading.Thread(
+            target=self._run_thread, name="ingest", daemon=True
+        ).start()
+
+    def _run_thread(self) -> None:
+        try:
+            asyncio.run(self.run())
+        except asyncio.CancelledError:
+            pass
+
+    # Stop taking messages, then wait for everything already accepted to
+    # be detected and committed before ending the pipeline
+    def stop(self, timeout: float = None) -> None:
+        if self._task is None:
+            return
+        self.client.loop_stop()
+        asyncio.run_coroutine_threadsafe(self._drain(), self._loop).result(
+            timeout
+        )
+        self._loop.call_soon_threadsafe(self._task.cancel)
+
+    async def _drain(self) -> None:
+        self._inbox_ready.set()
+        while (
+            self._inbox
+            or self._windows
+            or self._updates
+            or not self._detect.empty()
+            or self._pending_updates
+        ):
+            await asyncio.sleep(0.01)
+
+    async def run(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._task = asyncio.current_task()
+        self._inbox_ready = asyncio.Event()
+        self._roster_requested = asyncio.Event()
+        batches = max(1, self.queue_size // self.STAGE_BATCH)
+        self._detect = asyncio.Queue(batches)
+        self._persist = asyncio.Queue(batches)
+
+        # Commits are made one at a time on their own thread, roster reads
+        # use the loop's default executor and never wait behind them
+        executor = ThreadPoolExecutor(1, thread_name_prefix="database")
+        await self._loop.run_in_executor(None, self.refresh_roster)
+
+        self.client.connect()
+        self.client.loop_start()
+        stages = [
+            asyncio.ensure_future(stage)
+            for stage in (
+                self._parse_stage(),
+                self._detect_stage(),
+                self._persist_stage(executor),
+                self._roster_stage(),
+            )
+        ]
+        try:
+            await asyncio.gather(*stages)
+        finally:
+            for stage in stages:
+                stage.cancel()
+            self.client.loop_stop()
+            self._accepting.set()
+            executor.shutdown()
+
+    # Network thread: buffer the message and wake the parse stage once
+    def _on_message(self, client, userdata, message) -> None:
+        self._inbox.append(message)
+        if not self._wakeup_pending:
+            self._wakeup_pending = True
+            self._loop.call_soon_threadsafe(self._inbox_ready.set)
+
+        if len(self._inbox) >= self.queue_size:
+            self._accepting.clear()
+            if len(self._inbox) >= self.queue_size:
+                self._accepting.wait()
+
+    def _on_unknown_patient(self, patient_id: int) -> None:
+        if patient_id > self._roster_last_id:
+            self._roster_requested.set()
+
+    async def _parse_stage(self) -> None:
+        inbox = self._inbox
+        while True:
+            await self._inbox_ready.wait()
+            self._inbox_ready.clear()
+            self._wakeup_pending = False
+
+            while inbox:
+                message = inbox.popleft()
+                if (
+                    not self._accepting.is_set()
+                    and len(inbox) <= self.queue_size // 2
+                ):
+                    self._accepting.set()
+
+                self.dispatcher.dispatch(message.topic, message.payload)
+                self.processed += 1
+                if len(self._windows) >= self.STAGE_BATCH:
+                    await self._detect.put(self._windows)
+                    self._windows = []
+                if len(self._updates) >= self.STAGE_BATCH:
+                    await self._pass_updates()
+
+            if self._windows:
+                await self._detect.put(self._windows)
+                self._windows = []
+            if self._updates:
+                await self._pass_updates()
+
+    # The detect stage adds summaries too, so the list is swapped out before
+    # waiting on the queue
+    async def _pass_updates(self) -> None:
+        updates, self._updates = self._updates, []
+        self._pending_updates += len(updates)
+        await self._persist.put(updates)
+
+    def _queue_acceleration(self, patient_id: int, payload: bytes) -> None:
+        self._windows.append((patient_id, payload))
+
+    def _record(
+        self, patient_id: int, field: str, value, timestamp: int = None
+    ) -> None:
+        if timestamp is None:
+            timestamp = time.time_ns() // 1000000
+        self._updates.append((patient_id, field, value, timestamp))
+
+    async def _detect_stage(self) -> None:
+        while True:
+            windows = await self._detect.get()
+            for patient_id, payload in windows:
+                self._on_acceleration(patient_id, payload)
+            if self._updates:
+                await self._pass_updates()
+
+    # Same batching as TelemetryWriter.run, with the commit in the executor
+    async def _persist_stage(self, executor) -> None:
+        writer = self.telemetry_writer
+        queued = self._persist
+
+        # A get left waiting at a timeout is kept rather than cancelled, so
+        # no updates can be lost in between
+        getter = None
+        while True:
+            updates = await (getter or queued.get())
+            getter = None
+            batch = {}
+            history = []
+            received = 0
+
+            deadline = self._loop.time() + writer.flush_interval
+            while True:
+                for update in updates:
+                    writer.fold(batch, history, update)
+                received += len(updates)
+                if received >= writer.batch_size:
+                    break
+
+                try:
+                    updates = queued.get_nowait()
+                except asyncio.QueueEmpty:
+                    timeout = deadline - self._loop.time()
+                    if timeout <= 0:
+                        break
+                    getter = getter or asyncio.ensure_future(queued.get())
+                    done, _ = await asyncio.wait({getter}, timeout=timeout)
+                    if not done:
+                        break
+                    updates = getter.result()
+                    getter = None
+
+            writer.received += received
+            await self._loop.run_in_executor(
+                executor, self._flush, batch, history
+            )
+            self._pending_updates -= received
+
+    def _flush(self, batch: dict, history: list) -> None:
+        with self.pool.writer() as database:
+            self.telemetry_writer.flush(database, batch, history)
+
+    async def _roster_stage(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(
+                    self._roster_requested.wait(), self.ROSTER_INTERVAL
+                )
+            except asyncio.TimeoutError:
+                pass
+            self._roster_requested.clear()
+            await self._loop.run_in_executor(None, self.refresh_roster)
+            await asyncio.sleep(self.ROSTER_MIN_INTERVAL)
@@ -0,0 +1,208 @@
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9464
+LOG_INTERVAL = 60
+
+# Histogram bucket upper bounds in seconds, 1 us to about 17 s
+BUCKETS = tuple(1e-6 * 2**i for i in range(25))
+
+
+# Monotonic count. Updated without a lock: each is written from one thread
+# in practice, and a lost increment between threads only costs accuracy.
+class Counter:
+
+    __slots__ = ("value",)
+
+    def __init__(self) -> None:
+        self.value = 0
+
+    def inc(self, amount: int = 1) -> None:
+        self.value += amount
+
+
+# Counts of observations per bucket, plus their sum, lock-free like Counter
+class Histogram:
+
+    __slots__ = ("bounds", "counts", "sum")
+
+    def __init__(self, bounds: tuple = BUCKETS) -> None:
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def count(self) -> int:
+        return sum(self.counts)
+
+    # Upper bound of the bucket holding the q-th percentile
+    def percentile(self, q: float) -> float:
+        total = self.count()
+        if not total:
+            return None
+        rank = total * q / 100
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+# Registry of named metrics, exported as Prometheus text. Nothing is timed
+# unless enable() is called before the pipeline is built: timed then wraps
+# functions once, at construction, and otherwise hands back the function
+# unchanged, so a disabled build runs the same code as one without
+# instrumentation.
+class Metrics:
+    def __init__(self) -> None:
+        self.enabled = False
+
+        # Name -> (kind, help, {labels: metric or function})
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self._server = None
+
+    def enable(self) -> None:
+        self.enabled = True
+
+    def _register(self, kind: str, name: str, help: str, labels: dict, metric):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            metrics = self._metrics.setdefault(name, (kind, help, {}))[2]
+            # Counters and histograms are shared by everything registering
+            # the same name and labels, so they stay monotonic when a
+            # pipeline is rebuilt. Functions read live state and are replaced.
+            if callable(metric) or key not in metrics:
+                metrics[key] = metric
+            return metrics[key]
+
+    def counter(self, name: str, help: str, **labels) -> Counter:
+        return self._register("counter", name, help, labels, Counter())
+
+    def histogram(self, name: str, help: str, **labels) -> Histogram:
+        return self._register("histogram", name, help, labels, Histogram())
+
+    # Read a value at export time, for counts the code already keeps
+    def counter_function(self, name: str, help: str, function, **labels):
+        self._register("counter", name, help, labels, function)
+
+    def gauge(self, name: str, help: str, function, **labels) -> None:
+        self._register("gauge", name, help, labels, function)
+
+    # Record the duration of every call in a histogram
+    def timed(self, name: str, help: str, function, **labels):
+        if not self.enabled:
+            return function
+        observe = self.histogram(name, help, **labels).observe
+        perf_counter = time.perf_counter
+
+        def timed_function(*args, **kwargs):
+            start = perf_counter()
+            result = function(*args, **kwargs)
+            observe(perf_counter() - start)
+            return result
+
+        return timed_function
+
+    def _entries(self) -> list:
+        with self._lock:
+            return [
+                (name, kind, help, list(metrics.items()))
+                for name, (kind, help, metrics) in self._metrics.items()
+            ]
+
+    # Prometheus text exposition format
+    def render(self) -> str:
+        lines = []
+        for name, kind, help, metrics in self._entries():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, metric in metrics:
+                if kind == "histogram":
+                    cumulative = 0
+                    for bound, count in zip(
+                        metric.bounds + (float("inf"),), metric.counts
+                    ):
+                        cumulative += count
+                        le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                        bucket = _labels(labels + (("le", le),))
+                        lines.append(f"{name}_bucket{bucket} {cumulative}")
+                    lines.append(f"{name}_sum{_labels(labels)} {metric.sum}")
+                    lines.append(f"{name}_count{_labels(labels)} {cumulative}")
+                else:
+                    value = metric() if callable(metric) else metric.value
+                    lines.append(f"{name}{_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    # One line for the log: counts, gauges, and p50/p99 of each histogram
+    def summary(self) -> str:
+        parts = []
+        for name, kind, _, metrics in self._entries():
+            for labels, metric in metrics:
+                label = "/".join(str(value) for _, value in labels)
+                title = f"{name}{{{label}}}" if label else name
+                if kind == "histogram":
+                    if metric.count():
+                        parts.append(
+                            f"{title} {metric.count()} "
+                            f"p50<{metric.percentile(50) * 1000:g}ms "
+                            f"p99<{metric.percentile(99) * 1000:g}ms"
+                        )
+                else:
+                    value = metric() if callable(metric) else metric.value
+                    parts.append(f"{title} {value}")
+        return "Metrics: " + ", ".join(parts)
+
+    # Serve render() at /metrics on a daemon thread
+    def serve(self, port: int = METRICS_PORT, host: str = METRICS_HOST):
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header(
+                    "Content-Type", "text/plain; version=0.0.4; charset=utf-8"
+                )
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args) -> None:
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(
+            target=self._server.serve_forever, name="metrics", daemon=True
+        ).start()
+        print(f"Metrics: http://{host}:{self._server.server_port}/metrics")
+        return self._server
+
+    # Print summary() every interval seconds on a daemon thread
+    def log_periodically(self, interval: float = LOG_INTERVAL) -> None:
+        def log() -> None:
+            while True:
+                time.sleep(interval)
+                print(self.summary())
+
+        threading.Thread(target=log, name="metrics-log", daemon=True).start()
+
+
+def _labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    pairs = ",".join(f'{key}="{value}"' for key, value in labels)
+    return f"{{{pairs}}}"
+
+
+METRICS = Metrics()
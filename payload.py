@@ -0,0 +1,66 @@
+import struct
+import time
+
+import numpy as np
+
+# Binary acceleration payloads are a header followed by little-endian
+# float32 (x, y, z) triples. Text payloads ("x,y,z") from older devices
+# always start with a printable character, so the first byte tells them
+# apart from a binary version number.
+PAYLOAD_VERSION = 1
+
+# Version, flags, sample count, sequence number, timestamp (epoch ms)
+HEADER = struct.Struct("<BBHIQ")
+SAMPLE_DTYPE = np.dtype("<f4")
+SAMPLE_SIZE = 3 * SAMPLE_DTYPE.itemsize
+
+MAX_SAMPLES = 0xFFFF
+
+
+def is_binary(payload: bytes) -> bool:
+    return len(payload) > 0 and payload[0] < 0x20
+
+
+def encode_acceleration(
+    samples, sequence: int, timestamp: int = None
+) -> bytes:
+    samples = np.asarray(samples, dtype=SAMPLE_DTYPE).reshape(-1, 3)
+    if len(samples) > MAX_SAMPLES:
+        raise ValueError(f"At most {MAX_SAMPLES} samples per payload")
+    if timestamp is None:
+        timestamp = int(time.time() * 1000)
+
+    header = HEADER.pack(
+        PAYLOAD_VERSION, 0, len(samples), sequence & 0xFFFFFFFF, timestamp
+    )
+    return header + samples.tobytes()
+
+
+def _unpack_header(payload: bytes) -> tuple:
+    if len(payload) < HEADER.size:
+        raise ValueError("Truncated acceleration payload")
+
+    version, _, count, sequence, timestamp = HEADER.unpack_from(payload)
+    if version != PAYLOAD_VERSION:
+        raise ValueError(f"Unsupported payload version: {version}")
+    if len(payload) != HEADER.size + count * SAMPLE_SIZE:
+        raise ValueError("Acceleration payload length does not match header")
+    return count, sequence, timestamp
+
+
+# Returns an (N, 3) read-only view onto the payload, the sequence number and
+# the timestamp in epoch ms
+def decode_acceleration(payload: bytes) -> tuple:
+    count, sequence, timestamp = _unpack_header(payload)
+    samples = np.frombuffer(
+        payload, dtype=SAMPLE_DTYPE, count=count * 3, offset=HEADER.size
+    ).reshape(count, 3)
+    return samples, sequence, timestamp
+
+
+# Same as decode_acceleration, but returns a flat tuple of Python floats
+# (x0, y0, z0, x1, ...), cheaper than NumPy for a handful of samples
+def unpack_acceleration(payload: bytes) -> tuple:
+    count, sequence, timestamp = _unpack_header(payload)
+    values = struct.unpack_from(f"<{3 * count}f", payload, HEADER.size)
+    return values, sequence, timestamp
@@ -1,119 +1,704 @@
-import queue
 import threading
+import time
 from math import sqrt
 
-from database import DatabaseConnection
-from paho.mqtt import client as paho
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 
-BROKER_URL = "broker.mqttdashboard.com"
-BROKER_PORT = 1883
+from database import LOCATIONS, POOL, ConnectionPool, TelemetryWriter
+from metrics import METRICS
+from payload import decode_acceleration, is_binary
+from transport import TOPIC_PREFIX, PahoTransport
 
 SUBTOPICS = ["acceleration", "latitude", "longitude", "heartrate"]
-TOPIC_PREFIX = "BS2203FD"
+WILDCARD_TOPIC = f"{TOPIC_PREFIX}/+/+"
+
+# Also take older devices' topics, which a wildcard can't match, so each
+# patient is subscribed to in batches. Turned on with --legacy-topics.
+LEGACY_TOPICS = False
+SUBSCRIBE_BATCH = 100
+
+
+# Routes topics to per-subtopic handlers with the patient id already parsed
+class TopicDispatcher:
+
+    # Parsed routes are memoised, the memo is reset if it grows past this
+    MAX_ROUTES = 100000
+
+    def __init__(
+        self,
+        prefix: str = TOPIC_PREFIX,
+        subtopics: list = SUBTOPICS,
+        roster: set = None,
+        unknown_callback=None,
+    ) -> None:
+        self.prefix = prefix
+        self.legacy_prefix = f"{prefix}P?"
+        self.subtopics = tuple(subtopics)
+        self.unroutable = 0
+
+        # Messages for patients missing from the roster are dropped
+        self.roster = roster
+        self.unknown_callback = unknown_callback
+        self.unknown = 0
+
+        self._handlers = {}
+        self._routes = {}
+
+    def register(self, subtopic: str, handler) -> None:
+        if subtopic not in self.subtopics:
+            raise ValueError(f"Unknown subtopic: {subtopic}")
+        # The histogram's count is the number of messages received
+        self._handlers[subtopic] = METRICS.timed(
+            "ingest_message_seconds",
+            "Time to parse and handle a message, by subtopic",
+            handler,
+            subtopic=subtopic,
+        )
+        self._routes.clear()
+
+    # Call the handler for a topic, False if the topic is not routable
+    def dispatch(self, topic: str, payload: bytes) -> bool:
+        route = self._routes.get(topic)
+        if route is None:
+            route = self._parse(topic)
+            if route is None:
+                self.unroutable += 1
+                return False
+            if len(self._routes) >= self.MAX_ROUTES:
+                self._routes.clear()
+            self._routes[topic] = route
+
+        handler, patient_id = route
+        if self.roster is not None and patient_id not in self.roster:
+            self.unknown += 1
+            if self.unknown_callback is not None:
+                self.unknown_callback(patient_id)
+            return False
+
+        handler(patient_id, payload)
+        return True
+
+    # Either topic layout -> (handler, patient id)
+    def _parse(self, topic: str) -> tuple:
+        levels = topic.split("/")
+        if len(levels) == 3 and levels[0] == self.prefix:
+            _, patient_id, subtopic = levels
+        elif len(levels) == 2 and levels[0].startswith(self.legacy_prefix):
+            patient_id = levels[0][len(self.legacy_prefix) :]
+            subtopic = levels[1]
+        else:
+            return None
+
+        # isdigit() also accepts digits such as "²" that int() rejects
+        handler = self._handlers.get(subtopic)
+        if (
+            handler is None
+            or not patient_id.isascii()
+            or not patient_id.isdecimal()
+        ):
+            return None
+        return handler, int(patient_id)
 
 
 class MQTT:
-    def __init__(self, processor_callback, dashboard_callback) -> None:
-        self.client = paho.Client()
+
+    # Seconds between roster refreshes, and the minimum gap between an
+    # early refresh asked for by a message from an unknown patient
+    ROSTER_INTERVAL = 30
+    ROSTER_MIN_INTERVAL = 1
+
+    # Milliseconds of acceleration summarised by each peak magnitude kept
+    # in the telemetry history
+    SUMMARY_INTERVAL = 10000
+
+    # Heartrates outside this range can't be real readings
+    HEARTRATE_RANGE = range(0, 301)
+
+    def __init__(
+        self,
+        detector,
+        dashboard_callback,
+        telemetry_callback=None,
+        legacy_topics: bool = LEGACY_TOPICS,
+        transport=None,
+        pool: ConnectionPool = POOL,
+    ) -> None:
+        self.client = transport or PahoTransport()
+        self.pool = pool
         self.client.on_connect = self._on_connect
         self.client.on_subscribe = self._on_subscribe
         self.client.on_message = self._on_message
-        self.database_updates = queue.Queue()
+        self.telemetry_writer = TelemetryWriter(
+            commit_callback=telemetry_callback
+        )
+        self.database_updates = self.telemetry_writer.updates
 
-        self.processor_callback = processor_callback
+        self.detector = detector
         self.dashboard_callback = dashboard_callback
+        self.invalid_payloads = 0
+        self.sequence_gaps = 0
+        self._sequences = {}
+        self._peaks = {}
+        self.alert_coalescer = AlertCoalescer(dashboard_callback)
+        self.heartrate_analyser = HeartrateAnalyser(
+            dashboard_callback, falls=self.alert_coalescer
+        )
+        self.geofence_coalescer = AlertCoalescer(
+            dashboard_callback, kind="geofence"
+        )
+
+        self.legacy_topics = legacy_topics
+        self.roster = set()
+        self._roster_last_id = 0
+        self._roster_requested = threading.Event()
+
+        self.dispatcher = TopicDispatcher(
+            roster=self.roster, unknown_callback=self._on_unknown_patient
+        )
+        self.dispatcher.register("acceleration", self._on_acceleration)
+        self.dispatcher.register("latitude", self._on_latitude)
+        self.dispatcher.register("longitude", self._on_longitude)
+        self.dispatcher.register("heartrate", self._on_heartrate)
+
+        if METRICS.enabled:
+            self._register_metrics()
+
+    def _register_metrics(self) -> None:
+        writer = self.telemetry_writer
+        METRICS.gauge(
+            "telemetry_queue_depth",
+            "Telemetry updates waiting for the database writer",
+            self.database_updates.qsize,
+        )
+        METRICS.counter_function(
+            "telemetry_dropped_total",
+            "Telemetry updates dropped at the high-water mark",
+            lambda: writer.dropped,
+        )
+        METRICS.counter_function(
+            "telemetry_failed_total",
+            "Telemetry updates lost to a failed commit",
+            lambda: writer.failed,
+        )
+        METRICS.counter_function(
+            "telemetry_rows_written_total",
+            "Patient rows updated by the telemetry writer",
+            lambda: writer.rows_written,
+        )
+        for coalescer in (
+            self.alert_coalescer,
+            self.heartrate_analyser.alert_coalescer,
+            self.geofence_coalescer,
+        ):
+            METRICS.counter_function(
+                "alerts_raised_total",
+                "New alerts raised, by kind",
+                lambda coalescer=coalescer: coalescer.raised,
+                kind=coalescer.kind,
+            )
+        METRICS.counter_function(
+            "ingest_invalid_payloads_total",
+            "Messages whose payload could not be parsed",
+            lambda: self.invalid_payloads,
+        )
+        METRICS.counter_function(
+            "ingest_sequence_gaps_total",
+            "Acceleration windows lost or reordered on the way",
+            lambda: self.sequence_gaps,
+        )
+        METRICS.counter_function(
+            "ingest_unknown_patient_total",
+            "Messages dropped for patients missing from the roster",
+            lambda: self.dispatcher.unknown,
+        )
+        METRICS.counter_function(
+            "ingest_unroutable_total",
+            "Messages on topics that match no patient and subtopic",
+            lambda: self.dispatcher.unroutable,
+        )
 
     def begin(self) -> None:
-        self.client.connect(BROKER_URL, BROKER_PORT)
-        self._subscribe_patients()
-        threading.Thread(target=self._database_thread, daemon=True).start()
+        self.watch_geofences()
+        self.refresh_roster()
+        self.client.connect()
+        threading.Thread(
+            target=self._database_thread, name="database-writer", daemon=True
+        ).start()
+        threading.Thread(
+            target=self._roster_thread, name="roster", daemon=True
+        ).start()
         self.client.loop_start()
 
+    # Alert on geofence exits seen by this process's spatial index. Only
+    # the process receiving from the broker does this, shard workers never
+    # call begin.
+    def watch_geofences(self) -> None:
+        LOCATIONS.exit_callback = self._on_geofence_exit
+
+    def _on_geofence_exit(self, patient_id: int, kilometres: float) -> None:
+        self.geofence_coalescer.trigger(patient_id, kilometres)
+
     def _database_thread(self) -> None:
-        database = DatabaseConnection()
+        self.telemetry_writer.run(self.pool)
+
+    def _roster_thread(self) -> None:
         while True:
-            update = self.database_updates.get()
-            database.c.execute(*update)
-            database.db.commit()
+            self._roster_requested.wait(self.ROSTER_INTERVAL)
+            self._roster_requested.clear()
+            self.refresh_roster()
+            time.sleep(self.ROSTER_MIN_INTERVAL)
 
+    # Add patients created since the last refresh, returns their ids
+    def refresh_roster(self) -> list:
+        with self.pool.reader() as database:
+            patient_ids = database.get_patient_ids(after=self._roster_last_id)
+        if patient_ids:
+            self._roster_last_id = patient_ids[-1]
+            self.roster.update(patient_ids)
+            if self.legacy_topics:
+                self._subscribe_legacy(patient_ids)
+            print(f"Roster: {len(patient_ids)} new, {len(self.roster)} total")
+        return patient_ids
+
+    # Subscriptions are (re)made on every connect
     def _subscribe_patients(self) -> None:
-        database = DatabaseConnection()
-        for patient_id in database.get_patient_ids():
-            for subtopic in SUBTOPICS:
-                self.client.subscribe(
-                    f"{TOPIC_PREFIX}P?{patient_id}/{subtopic}"
-                )
-            print(f"Subscribing Patient: {TOPIC_PREFIX}P?{patient_id}/Any")
+        self.client.subscribe(WILDCARD_TOPIC)
+        print(f"Subscribing Patients: {WILDCARD_TOPIC}")
+        if self.legacy_topics:
+            self._subscribe_legacy(sorted(self.roster))
+
+    # One SUBSCRIBE per batch of topics rather than one per topic
+    def _subscribe_legacy(self, patient_ids: list) -> None:
+        topics = [
+            (f"{TOPIC_PREFIX}P?{patient_id}/{subtopic}", 0)
+            for patient_id in patient_ids
+            for subtopic in SUBTOPICS
+        ]
+        for start in range(0, len(topics), SUBSCRIBE_BATCH):
+            self.client.subscribe(topics[start : start + SUBSCRIBE_BATCH])
+
+    def _on_unknown_patient(self, patient_id: int) -> None:
+        if patient_id > self._roster_last_id:
+            self._roster_requested.set()
 
     def _on_connect(self, client, userdata, flags, rc) -> None:
         print(f"Connection Acknowledged with Code: {rc}")
+        self._subscribe_patients()
 
     def _on_subscribe(self, client, userdata, mid, granted_qos) -> None:
         # print(f"MQTT Client Subscribed: {mid} QOS:{granted_qos[0]}")
         pass
 
     def _on_message(self, client, userdata, message) -> None:
-        subtopic = message.topic.split("/")[1]
-        patient_id = message.topic.split("?")[1][0]
-        payload = message.payload.decode("UTF-8")
-
-        # print(f"Patient {patient_id}", end=" ")
-        # print(f"Subtopic: {subtopic}", end=" ")
-
-        if "acceleration" in subtopic:
-            acceleration = [float(value) for value in payload.split(",")]
-            if self.processor_callback(tuple(acceleration)):
-                self.dashboard_callback(int(patient_id))
-
-        elif "longitude" in subtopic:
-            # print(f"Longitude: {payload}")
-            self.database_updates.put(
-                (
-                    """UPDATE patients
-                       SET longitude = ?
-                       WHERE id = ?""",
-                    [payload, patient_id],
+        self.dispatcher.dispatch(message.topic, message.payload)
+
+    # Binary payloads carry a window of samples, text payloads hold one
+    def _on_acceleration(self, patient_id: int, payload: bytes) -> None:
+        try:
+            if is_binary(payload):
+                samples, sequence, _ = decode_acceleration(payload)
+                self._check_sequence(patient_id, sequence)
+                # Well-formed but empty, there is nothing to detect on
+                if not len(samples):
+                    return
+                impacts = self.detector.extend(patient_id, samples)
+                peak = float(FallDetector.magnitudes(samples).max())
+            else:
+                acceleration = [float(value) for value in payload.split(b",")]
+                peak = sqrt(sum(value * value for value in acceleration))
+                impacts = []
+                if self.detector.analyse(patient_id, acceleration):
+                    impacts.append(self.detector.impact(patient_id))
+        except ValueError:
+            self.invalid_payloads += 1
+            return
+
+        self._summarise(patient_id, peak)
+        for magnitude in impacts:
+            self.alert_coalescer.trigger(patient_id, magnitude)
+
+    # Keep the peak magnitude of each SUMMARY_INTERVAL, written to the
+    # history once the next interval's first window arrives
+    def _summarise(self, patient_id: int, peak: float) -> None:
+        now = time.time_ns() // 1000000
+        start = now - now % self.SUMMARY_INTERVAL
+        summary = self._peaks.get(patient_id)
+        if summary is None or summary[0] != start:
+            if summary is not None:
+                self._record(
+                    patient_id, "acceleration", summary[1], summary[0]
                 )
+            self._peaks[patient_id] = [start, peak]
+        elif peak > summary[1]:
+            summary[1] = peak
+
+    def _record(
+        self, patient_id: int, field: str, value, timestamp: int = None
+    ) -> None:
+        self.telemetry_writer.put(patient_id, field, value, timestamp)
+
+    # Count messages lost or reordered between a device and the broker
+    def _check_sequence(self, patient_id: int, sequence: int) -> None:
+        last = self._sequences.get(patient_id)
+        if last is not None and sequence != (last + 1) & 0xFFFFFFFF:
+            self.sequence_gaps += 1
+        self._sequences[patient_id] = sequence
+
+    def _on_latitude(self, patient_id: int, payload: bytes) -> None:
+        self._on_coordinate(patient_id, "latitude", payload)
+
+    def _on_longitude(self, patient_id: int, payload: bytes) -> None:
+        self._on_coordinate(patient_id, "longitude", payload)
+
+    # Coordinates are stored as numbers, text that isn't one is dropped
+    def _on_coordinate(
+        self, patient_id: int, field: str, payload: bytes
+    ) -> None:
+        try:
+            self._record(patient_id, field, float(payload))
+        except ValueError:
+            self.invalid_payloads += 1
+
+    def _on_heartrate(self, patient_id: int, payload: bytes) -> None:
+        try:
+            heartrate = int(payload)
+        except ValueError:
+            heartrate = None
+        if heartrate not in self.HEARTRATE_RANGE:
+            self.invalid_payloads += 1
+            return
+        self.heartrate_analyser.update(patient_id, heartrate)
+        self._record(patient_id, "heartrate", heartrate)
+
+
+# Folds repeated triggers of one kind of alert for a patient into one
+# ongoing alert. The dashboard callback is given (patient_id, first
+# timestamp, last timestamp, count, peak magnitude, kind, severity).
+class AlertCoalescer:
+
+    # Seconds after a trigger during which another one updates the same alert
+    WINDOW = 60
+
+    def __init__(
+        self, dashboard_callback, window: float = WINDOW, kind: str = "fall"
+    ) -> None:
+        self.dashboard_callback = dashboard_callback
+        self.window = window
+        self.kind = kind
+        self.raised = 0
+        self.suppressed = 0
+
+        # Patient id -> [first timestamp, last timestamp, count, peak,
+        # severity]
+        self._incidents = {}
+
+    def trigger(
+        self,
+        patient_id: int,
+        magnitude: float,
+        timestamp: float = None,
+        severity: int = 1,
+    ) -> None:
+        if timestamp is None:
+            timestamp = time.time()
+
+        incident = self._incidents.get(patient_id)
+        if incident is None or timestamp - incident[1] > self.window:
+            incident = [timestamp, timestamp, 1, magnitude, severity]
+            self._incidents[patient_id] = incident
+            self.raised += 1
+        else:
+            incident[1] = timestamp
+            incident[2] += 1
+            incident[3] = max(incident[3], magnitude)
+            incident[4] = max(incident[4], severity)
+            self.suppressed += 1
+
+        # The first timestamp identifies the alert to create or update
+        self.dashboard_callback(
+            patient_id, *incident[:4], self.kind, incident[4]
+        )
+
+    # Whether the patient was last triggered within the given seconds
+    def recent(
+        self, patient_id: int, seconds: float, timestamp: float = None
+    ) -> bool:
+        incident = self._incidents.get(patient_id)
+        if incident is None:
+            return False
+        if timestamp is None:
+            timestamp = time.time()
+        return timestamp - incident[1] <= seconds
+
+
+# Streaming heartrate check for every patient. Each keeps a running mean
+# and variance, weighted equally over the first 1 / ALPHA readings as in
+# Welford's method and exponentially after that, so the bounds follow the
+# patient's own normal. A reading more than DEVIATIONS standard deviations
+# from the mean, or outside LOW to HIGH, raises a "heartrate" alert, with
+# a higher severity within FALL_WINDOW seconds of a fall.
+class HeartrateAnalyser:
+
+    ALPHA = 1 / 30
+    DEVIATIONS = 4.0
+
+    # Readings needed before the adaptive bounds are used
+    WARMUP = 30
+
+    # Standard deviation floor, so a very steady heartrate does not turn
+    # every small change into an anomaly
+    MIN_DEVIATION = 5.0
+
+    # Beats per minute that are anomalous whatever the patient's normal
+    LOW = 40
+    HIGH = 150
+
+    FALL_WINDOW = 300
+
+    def __init__(
+        self,
+        dashboard_callback,
+        falls: AlertCoalescer = None,
+        window: float = AlertCoalescer.WINDOW,
+    ) -> None:
+        self.alert_coalescer = AlertCoalescer(
+            dashboard_callback, window, kind="heartrate"
+        )
+        self.falls = falls
+        self.anomalies = 0
+
+        # Patient id -> [readings, mean, variance]
+        self._baselines = {}
+
+    # Returns whether the reading was anomalous. The magnitude alerted is
+    # how far the reading is from the patient's mean, or from the nearest
+    # limit before there is one.
+    def update(
+        self, patient_id: int, heartrate: int, timestamp: float = None
+    ) -> bool:
+        baseline = self._baselines.get(patient_id)
+        if baseline is None:
+            self._baselines[patient_id] = [1, float(heartrate), 0.0]
+            deviation = heartrate - min(max(heartrate, self.LOW), self.HIGH)
+            anomalous = deviation != 0
+        else:
+            readings, mean, variance = baseline
+            deviation = heartrate - mean
+            anomalous = not self.LOW <= heartrate <= self.HIGH or (
+                readings >= self.WARMUP
+                and abs(deviation)
+                > self.DEVIATIONS * max(sqrt(variance), self.MIN_DEVIATION)
             )
 
-        elif "latitude" in subtopic:
-            # print(f"Latitude: {payload}")
-            self.database_updates.put(
-                (
-                    """UPDATE patients
-                       SET latitude = ?
-                       WHERE id = ?""",
-                    [payload, patient_id],
-                )
+            alpha = max(1 / (readings + 1), self.ALPHA)
+            baseline[0] = readings + 1
+            baseline[1] = mean + alpha * deviation
+            baseline[2] = (1 - alpha) * (
+                variance + alpha * deviation * deviation
             )
 
-        elif "heartrate" in subtopic:
-            # print(f"Heartrate (BPM): {int(payload)}")
-            self.database_updates.put(
-                (
-                    """UPDATE patients
-                       SET heartrate = ?
-                       WHERE id = ?""",
-                    [payload, patient_id],
-                )
+        if anomalous:
+            self.anomalies += 1
+            if timestamp is None:
+                timestamp = time.time()
+            severity = 1
+            if self.falls is not None and self.falls.recent(
+                patient_id, self.FALL_WINDOW, timestamp
+            ):
+                severity = 2
+            self.alert_coalescer.trigger(
+                patient_id, abs(deviation), timestamp, severity
             )
+        return anomalous
+
+    # (readings, mean, standard deviation) for a patient, or None
+    def baseline(self, patient_id: int) -> tuple:
+        baseline = self._baselines.get(patient_id)
+        if baseline is None:
+            return None
+        return baseline[0], baseline[1], sqrt(baseline[2])
+
+    def forget(self, patient_id: int) -> None:
+        self._baselines.pop(patient_id, None)
+
+
+# Fixed-size ring buffer of acceleration magnitudes for one patient
+class SampleWindow:
+    def __init__(self, size: int) -> None:
+        self.size = size
+        self.count = 0
+        self._head = 0
+
+        # Samples are written twice so the latest window is always contiguous
+        self._samples = np.zeros(2 * size)
+
+    def append(self, magnitude: float) -> None:
+        self._samples[self._head] = magnitude
+        self._samples[self._head + self.size] = magnitude
+        self._head = (self._head + 1) % self.size
+        self.count += 1
+
+    def extend(self, magnitudes: np.ndarray) -> None:
+        self.count += len(magnitudes)
+        magnitudes = magnitudes[-self.size :]
 
+        first = min(len(magnitudes), self.size - self._head)
+        for start, values in (
+            (self._head, magnitudes[:first]),
+            (0, magnitudes[first:]),
+        ):
+            self._samples[start : start + len(values)] = values
+            self._samples[
+                start + self.size : start + self.size + len(values)
+            ] = values
+        self._head = (self._head + len(magnitudes)) % self.size
 
+    # View of the latest samples, oldest first
+    def window(self) -> np.ndarray:
+        return self._samples[self._head : self._head + self.size]
+
+
+# Detects a free fall, followed by an impact, followed by inactivity
 class FallDetector:
 
-    THRESHOLD = 10
+    SAMPLE_RATE = 50
 
-    @staticmethod
-    def analyse(acc: tuple) -> bool:
+    IMPACT_THRESHOLD = 10
+    FREE_FALL_THRESHOLD = 0.6
+    INACTIVITY_TOLERANCE = 0.5
+
+    # Seconds searched for a free fall before, and inactivity after, an impact
+    FREE_FALL_WINDOW = 1.0
+    INACTIVITY_WINDOW = 2.0
+
+    def __init__(
+        self,
+        sample_rate: float = SAMPLE_RATE,
+        impact_threshold: float = IMPACT_THRESHOLD,
+        free_fall_threshold: float = FREE_FALL_THRESHOLD,
+        inactivity_tolerance: float = INACTIVITY_TOLERANCE,
+        free_fall_window: float = FREE_FALL_WINDOW,
+        inactivity_window: float = INACTIVITY_WINDOW,
+    ) -> None:
+        self.impact_threshold = impact_threshold
+        self.free_fall_threshold = free_fall_threshold
+        self.inactivity_tolerance = inactivity_tolerance
+
+        self.free_fall_samples = max(1, round(free_fall_window * sample_rate))
+        self.inactivity_samples = max(
+            1, round(inactivity_window * sample_rate)
+        )
+        self.window_size = self.free_fall_samples + 1 + self.inactivity_samples
+
+        self._windows = {}
+
+        if METRICS.enabled:
+            for method in ("analyse", "extend"):
+                setattr(
+                    self,
+                    method,
+                    METRICS.timed(
+                        "detector_seconds",
+                        "Time the fall detector spends per call, by method",
+                        getattr(self, method),
+                        method=method,
+                    ),
+                )
+
+    # Feed one sample for a patient, True once a fall has been confirmed
+    def analyse(self, patient_id: int, acc: tuple) -> bool:
         try:
-            total_acceleration = sqrt(
+            magnitude = sqrt(
                 (acc[0] * acc[0]) + (acc[1] * acc[1]) + (acc[2] * acc[2])
             )
         except IndexError:
             # Catch if the sample is invalid
             return False
 
-        if total_acceleration > FallDetector.THRESHOLD:
-            return True
-        else:
+        window = self._windows.get(patient_id)
+        if window is None:
+            window = SampleWindow(self.window_size)
+            self._windows[patient_id] = window
+
+        window.append(magnitude)
+        if window.count < self.window_size:
             return False
+        return bool(self._detect(window.window()[np.newaxis])[0])
+
+    # Feed a window of (N, 3) samples for a patient straight into its ring
+    # buffer, returns the impact magnitudes of any falls confirmed
+    def extend(self, patient_id: int, samples: np.ndarray) -> np.ndarray:
+        magnitudes = FallDetector.magnitudes(
+            np.asarray(samples, dtype=np.float64)
+        )
+
+        window = self._windows.get(patient_id)
+        if window is None:
+            window = SampleWindow(self.window_size)
+            self._windows[patient_id] = window
+
+        # Every window ending at one of the new samples
+        history = np.concatenate((window.window()[1:], magnitudes))
+        windows = sliding_window_view(history, self.window_size)
+        first_complete = max(0, self.window_size - 1 - window.count)
+        window.extend(magnitudes)
+
+        falls = self._detect(windows)
+        falls[:first_complete] = False
+        return history[np.flatnonzero(falls) + self.free_fall_samples]
+
+    # Replay an (N, 3) array of samples from many patients in one pass,
+    # returning the decision analyse() would have made for each sample
+    def analyse_batch(
+        self, samples: np.ndarray, patient_ids: np.ndarray
+    ) -> np.ndarray:
+        samples = np.asarray(samples, dtype=np.float64)
+        patient_ids = np.asarray(patient_ids)
+        falls = np.zeros(len(samples), dtype=bool)
+        if len(samples) < self.window_size:
+            return falls
+
+        # Group each patient's samples together, keeping arrival order
+        order = np.argsort(patient_ids, kind="stable")
+        ids = patient_ids[order]
+        windows = sliding_window_view(
+            FallDetector.magnitudes(samples[order]), self.window_size
+        )
+
+        # Only windows lying entirely within one patient's samples count
+        valid = ids[: len(windows)] == ids[self.window_size - 1 :]
+        falls[order[self.window_size - 1 :]] = self._detect(windows) & valid
+        return falls
+
+    # Magnitude of the impact in a patient's latest window
+    def impact(self, patient_id: int) -> float:
+        return float(
+            self._windows[patient_id].window()[self.free_fall_samples]
+        )
+
+    def forget(self, patient_id: int) -> None:
+        self._windows.pop(patient_id, None)
+
+    # Same arithmetic as analyse() so both paths agree bit for bit
+    @staticmethod
+    def magnitudes(samples: np.ndarray) -> np.ndarray:
+        x, y, z = samples[:, 0], samples[:, 1], samples[:, 2]
+        return np.sqrt((x * x) + (y * y) + (z * z))
+
+    # Judge a stack of windows, each is checked once when its impact
+    # sample has aged past the inactivity period
+    def _detect(self, windows: np.ndarray) -> np.ndarray:
+        impact = self.free_fall_samples
+        falls = windows[:, impact] > self.impact_threshold
+        if not falls.any():
+            return falls
+
+        candidates = windows[falls]
+        falls[falls] = (
+            candidates[:, :impact].min(axis=1) <= self.free_fall_threshold
+        ) & (
+            np.ptp(candidates[:, impact + 1 :], axis=1)
+            <= self.inactivity_tolerance
+        )
+        return falls
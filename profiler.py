@@ -0,0 +1,172 @@
+import os
+import signal
+import sys
+import threading
+import time
+
+PROFILE_INTERVAL = 0.01
+PROFILE_FILE = "profile-%Y%m%d-%H%M%S.folded"
+
+# Pipeline stage of each thread, by the start of the thread's name
+THREAD_STAGES = (
+    ("MainThread", "tk"),
+    ("memory-transport", "transport"),
+    ("paho", "transport"),
+    ("database-writer", "database"),
+    ("database", "database"),
+    ("asyncio", "roster"),
+    ("roster", "roster"),
+    ("ingest", "ingest"),
+    ("shard-", "shard"),
+    ("simulator", "simulator"),
+    ("metrics", "metrics"),
+    ("profiler", "profiler"),
+)
+
+# Functions that narrow a sample down to a stage within its thread. They are
+# only on the stack while running, so their share of samples is their load.
+FUNCTION_STAGES = {
+    "_synchronise": "synchronise",
+    "_parse_stage": "parse",
+    "_detect_stage": "detect",
+    "_persist_stage": "persist",
+}
+
+# Samples the stacks of every thread from its own daemon thread. Stacks are
+# kept as tuples of code objects and only turned into text when written, so
+# a sample costs a walk of each thread's frames. Each write covers the time
+# since the previous one and is in the collapsed format flamegraph.pl and
+# speedscope read, with the stage and thread name as the root frames. A
+# blocked thread still has a stack, so the CPU time of each thread's stage
+# is printed alongside where the platform has per-thread clocks.
+class Profiler:
+    def __init__(self, interval: float = PROFILE_INTERVAL) -> None:
+        self.interval = interval
+        self.samples = 0
+
+        # (thread name, code objects innermost first) -> samples
+        self._stacks = {}
+        self._names = {}
+        self._started = time.time()
+        self._cpu = {}
+        self._write_requested = threading.Event()
+        self._thread = None
+
+    def start(self) -> None:
+        self._started = time.time()
+        self._cpu = _cpu_times()
+        self._thread = threading.Thread(
+            target=self._run, name="profiler", daemon=True
+        )
+        self._thread.start()
+
+        # kill -USR1 <pid> writes a profile, where the platform has it
+        if hasattr(signal, "SIGUSR1"):
+            signal.signal(signal.SIGUSR1, lambda *_: self.request_write())
+
+    # Safe from a signal handler or the Tk loop: the write itself is done
+    # by the sampling thread, which owns the stacks
+    def request_write(self) -> None:
+        self._write_requested.set()
+
+    def _run(self) -> None:
+        own = threading.get_ident()
+        while True:
+            time.sleep(self.interval)
+            self.sample(own)
+            if self._write_requested.is_set():
+                self._write_requested.clear()
+                self.write()
+
+    def sample(self, skip: int = None) -> None:
+        frames = sys._current_frames()
+        if frames.keys() != self._names.keys():
+            self._names = {
+                thread.ident: thread.name for thread in threading.enumerate()
+            }
+
+        stacks = self._stacks
+        for ident, frame in frames.items():
+            if ident == skip:
+                continue
+            codes = []
+            while frame is not None:
+                codes.append(frame.f_code)
+                frame = frame.f_back
+            key = (self._names.get(ident, str(ident)), tuple(codes))
+            stacks[key] = stacks.get(key, 0) + 1
+        self.samples += 1
+
+    # Write the stacks sampled since the last write, returns the path
+    def write(self, path: str = None) -> str:
+        if path is None:
+            path = time.strftime(PROFILE_FILE)
+        stacks, self._stacks = self._stacks, {}
+        samples, self.samples = self.samples, 0
+        elapsed = time.time() - self._started
+        self._started = time.time()
+        cpu, self._cpu = self._cpu, _cpu_times()
+
+        # Samples in each function stage
+        functions = dict.fromkeys(FUNCTION_STAGES.values(), 0)
+        with open(path, "w") as file:
+            for (name, codes), count in stacks.items():
+                stage = thread_stage(name, codes)
+                frames = ";".join(_frame(code) for code in reversed(codes))
+                file.write(f"{stage};{name};{frames} {count}\n")
+                if stage in functions:
+                    functions[stage] += count
+
+        # Seconds of CPU used by each thread stage
+        threads = {}
+        for ident, (name, seconds) in self._cpu.items():
+            stage = thread_stage(name, ())
+            used = seconds - cpu.get(ident, (name, 0.0))[1]
+            threads[stage] = threads.get(stage, 0.0) + used
+
+        print(f"Profile: {samples} samples over {elapsed:.1f}s to {path}")
+        parts = [
+            f"{stage} {seconds / elapsed:.0%} cpu"
+            for stage, seconds in sorted(
+                threads.items(), key=lambda item: item[1], reverse=True
+            )
+        ]
+        if samples:
+            parts += [
+                f"{stage} in {count / samples:.0%} of samples"
+                for stage, count in functions.items()
+                if count
+            ]
+        if parts:
+            print("Profile: " + ", ".join(parts))
+        return path
+
+
+def thread_stage(name: str, codes: tuple) -> str:
+    for code in codes:
+        stage = FUNCTION_STAGES.get(code.co_name)
+        if stage is not None:
+            return stage
+    for prefix, stage in THREAD_STAGES:
+        if name.startswith(prefix):
+            return stage
+    return "other"
+
+
+# Thread ident -> (name, seconds of CPU used), empty without pthread clocks
+def _cpu_times() -> dict:
+    if not hasattr(time, "pthread_getcpuclockid"):
+        return {}
+    times = {}
+    for thread in threading.enumerate():
+        try:
+            clock = time.pthread_getcpuclockid(thread.ident)
+            times[thread.ident] = (thread.name, time.clock_gettime(clock))
+        except (OSError, TypeError):
+            pass
+    return times
+
+
+def _frame(code) -> str:
+    filename = os.path.basename(code.co_filename)
+    return f"{code.co_name} ({filename}:{code.co_firstlineno})"
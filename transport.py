@@ -0,0 +1,197 @@
+import queue
+import threading
+
+from paho.mqtt import client as paho
+
+BROKER_URL = "broker.mqttdashboard.com"
+BROKER_PORT = 1883
+
+# Shared by the devices that publish and the dashboard that subscribes.
+# Devices publish to "<prefix>/<patient id>/<subtopic>", older devices to
+# "<prefix>P?<patient id>/<subtopic>".
+TOPIC_PREFIX = "BS2203FD"
+
+# Transports share paho's callback signatures (on_connect, on_subscribe,
+# on_message, on_publish) and the connect, loop_start, loop_stop, subscribe
+# and publish calls, so MQTT classes work with any of them unchanged.
+
+
+# Talks to a real broker over the network
+class PahoTransport:
+
+    CALLBACKS = ("on_connect", "on_subscribe", "on_message", "on_publish")
+
+    def __init__(
+        self, host: str = BROKER_URL, port: int = BROKER_PORT
+    ) -> None:
+        self.host = host
+        self.port = port
+        self.client = paho.Client()
+
+        self.on_connect = None
+        self.on_subscribe = None
+        self.on_message = None
+        self.on_publish = None
+
+    def connect(self) -> None:
+        for name in PahoTransport.CALLBACKS:
+            callback = getattr(self, name)
+            if callback is not None:
+                setattr(self.client, name, callback)
+        self.client.connect(self.host, self.port)
+
+    def loop_start(self) -> None:
+        self.client.loop_start()
+        # Named like the other pipeline threads, paho leaves it unnamed
+        if getattr(self.client, "_thread", None) is not None:
+            self.client._thread.name = "paho"
+
+    def loop_stop(self) -> None:
+        self.client.loop_stop()
+
+    def subscribe(self, topic) -> None:
+        self.client.subscribe(topic)
+
+    def publish(self, topic: str, payload) -> None:
+        self.client.publish(topic, payload)
+
+
+# Same attributes on_message handlers read from a paho MQTTMessage
+class Message:
+
+    __slots__ = ("topic", "payload")
+
+    def __init__(self, topic: str, payload: bytes) -> None:
+        self.topic = topic
+        self.payload = payload
+
+
+def topic_matches(topic_filter: str, topic: str) -> bool:
+    filter_levels = topic_filter.split("/")
+    topic_levels = topic.split("/")
+    for index, level in enumerate(filter_levels):
+        if level == "#":
+            return True
+        if index >= len(topic_levels):
+            return False
+        if level != "+" and level != topic_levels[index]:
+            return False
+    return len(filter_levels) == len(topic_levels)
+
+
+# In-process broker. Published payloads are handed to every matching
+# subscriber as the same object, without a network hop or a copy.
+class MemoryBus:
+
+    # Topics whose matching subscribers are remembered
+    MAX_ROUTES = 100000
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._subscriptions = []
+        self._routes = {}
+
+    def subscribe(self, transport, topic_filter: str) -> None:
+        with self._lock:
+            self._subscriptions.append((topic_filter, transport))
+            self._routes.clear()
+
+    def unsubscribe(self, transport) -> None:
+        with self._lock:
+            self._subscriptions = [
+                entry
+                for entry in self._subscriptions
+                if entry[1] is not transport
+            ]
+            self._routes.clear()
+
+    def publish(self, topic: str, payload: bytes) -> None:
+        subscribers = self._routes.get(topic)
+        if subscribers is None:
+            with self._lock:
+                subscribers = {
+                    transport
+                    for topic_filter, transport in self._subscriptions
+                    if topic_matches(topic_filter, topic)
+                }
+                if len(self._routes) < MemoryBus.MAX_ROUTES:
+                    self._routes[topic] = subscribers
+
+        if subscribers:
+            message = Message(topic, payload)
+            for transport in subscribers:
+                transport.inbox.put(message)
+
+
+# Default bus for a simulator and dashboard sharing one process
+BUS = MemoryBus()
+
+
+# Connects to a MemoryBus, callbacks run on the transport's own loop thread
+# like paho's network thread
+class MemoryTransport:
+    def __init__(self, bus: MemoryBus = BUS) -> None:
+        self.bus = bus
+        self.inbox = queue.SimpleQueue()
+        self.published = 0
+        self.delivered = 0
+        self._thread = None
+        self._mid = 0
+
+        self.on_connect = None
+        self.on_subscribe = None
+        self.on_message = None
+        self.on_publish = None
+
+    def connect(self) -> None:
+        self.inbox.put(self._connected)
+
+    def loop_start(self) -> None:
+        self._thread = threading.Thread(
+            target=self._loop, name="memory-transport", daemon=True
+        )
+        self._thread.start()
+
+    def loop_stop(self) -> None:
+        if self._thread is not None:
+            self.inbox.put(None)
+            self._thread.join()
+            self._thread = None
+        self.bus.unsubscribe(self)
+
+    def subscribe(self, topic) -> None:
+        topics = [topic] if isinstance(topic, str) else topic
+        for entry in topics:
+            self.bus.subscribe(
+                self, entry if isinstance(entry, str) else entry[0]
+            )
+
+        self._mid += 1
+        if self.on_subscribe is not None:
+            self.on_subscribe(self, None, self._mid, (0,) * len(topics))
+
+    def publish(self, topic: str, payload) -> None:
+        # Encoded the way paho does, so handlers always receive bytes
+        if not isinstance(payload, (bytes, bytearray)):
+            payload = str(payload).encode()
+        self.bus.publish(topic, payload)
+        self.published += 1
+
+        self._mid += 1
+        if self.on_publish is not None:
+            self.on_publish(self, None, self._mid)
+
+    def _connected(self) -> None:
+        if self.on_connect is not None:
+            self.on_connect(self, None, {}, 0)
+
+    def _loop(self) -> None:
+        while True:
+            message = self.inbox.get()
+            if message is None:
+                return
+            if callable(message):
+                message()
+            elif self.on_message is not None:
+                self.on_message(self, None, message)
+                self.delivered += 1